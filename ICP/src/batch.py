@@ -0,0 +1,83 @@
+import os
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from icp import PointCloud, ICP
+from coarse import FeatureAlignment
+
+
+def get_pairs(pattern):
+    # a directory means every <name>_A.txt with a <name>_B.txt in it, otherwise pattern is a glob of sources
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*_A.txt')
+    pairs = []
+    for source in sorted(glob.glob(pattern)):
+        root, extension = os.path.splitext(source)
+        target = root[:-2] + '_B' + extension
+        if root.endswith('_A') and os.path.exists(target):
+            pairs.append((source, target))
+    return pairs
+
+
+def get_name(source):
+    # name of a pair is its source file name without extension and _A
+    name = os.path.splitext(os.path.basename(source))[0]
+    return name[:-2] if name.endswith('_A') else name
+
+
+def run_job(source, target, directory, method, max_iter, tolerance, levels, coarse, plot):
+    # register one pair and write its manifest
+    start = time.perf_counter()
+    name = get_name(source)
+    icp = ICP(PointCloud(path=source), PointCloud(path=target), name, method)
+    # the pool already runs one pair per core
+    icp.workers = 1
+    if coarse:
+        icp.R, icp.T = FeatureAlignment(workers=icp.workers).align(icp.pc_source, icp.pc_target)
+    if levels > 1:
+        icp.train_pyramid(levels, max_iter, tolerance, plot)
+    else:
+        icp.train(max_iter, tolerance, plot)
+    manifest = {'name': name, 'source': source, 'target': target, 'method': method,
+                'transformation': icp.get_transformation().tolist(), 'rms': float(icp.rms),
+                'iterations': icp.iterations, 'level_iterations': icp.level_iterations,
+                'time': time.perf_counter() - start}
+    with open(os.path.join(directory, '{}.json'.format(name)), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def run_batch(pairs, directory='../results/batch', method='point', max_iter=10, tolerance=1e-4, levels=1,
+              coarse=False, plot=False, workers=None):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    print('Batch of {} pairs'.format(len(pairs)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_job, source, target, directory, method, max_iter, tolerance, levels, coarse,
+                                   plot) for source, target in pairs]
+        return [future.result() for future in futures]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Register pairs of point clouds with ICP.')
+    parser.add_argument('pattern', nargs='?', default='../assets',
+                        help='directory of <name>_A.txt & <name>_B.txt pairs, or glob of sources')
+    parser.add_argument('--pairs', nargs='+', default=None, help='source & target paths, alternately')
+    parser.add_argument('--output', default='../results/batch', help='directory of manifests')
+    parser.add_argument('--method', choices=ICP.methods, default='point', help='ICP method')
+    parser.add_argument('--iterations', type=int, default=10, help='maximum number of ICP iterations')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='relative change to stop at')
+    parser.add_argument('--levels', type=int, default=1, help='levels of the voxel pyramid')
+    parser.add_argument('--coarse', action='store_true', help='seed ICP with a global alignment')
+    parser.add_argument('--plot', action='store_true', help='save figures of every iteration')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+    if args.pairs:
+        assert len(args.pairs) % 2 == 0, 'pairs need a target for every source'
+        pairs = list(zip(args.pairs[::2], args.pairs[1::2]))
+    else:
+        pairs = get_pairs(args.pattern)
+    run_batch(pairs, args.output, args.method, args.iterations, args.tolerance, args.levels, args.coarse, args.plot,
+              args.workers)
@@ -0,0 +1,138 @@
+import numpy as np
+from scipy.spatial import KDTree
+
+
+def kabsch(p, q):
+    # best rotations & translations moving point sets p onto q, batched over the first axis
+    centroid_p = p.mean(axis=1)
+    centroid_q = q.mean(axis=1)
+    H = np.einsum('bni,bnj->bij', p - centroid_p[:, None], q - centroid_q[:, None])
+    U, S, V = np.linalg.svd(H)
+    # flip the last axis of reflections
+    D = np.tile(np.eye(3), (len(H), 1, 1))
+    D[:, 2, 2] = np.sign(np.linalg.det(V.transpose(0, 2, 1) @ U.transpose(0, 2, 1)))
+    R = V.transpose(0, 2, 1) @ D @ U.transpose(0, 2, 1)
+    T = centroid_q - np.einsum('bij,bj->bi', R, centroid_p)
+    return R, T
+
+
+def get_pair_features(points, normals, idx, valid):
+    # angles between every point and its neighbours, from the point whose normal is closer to their line
+    d = points[idx] - points[:, None]
+    distance = np.linalg.norm(d, axis=2)
+    d /= np.where(valid, distance, 1)[:, :, None]
+    n_1 = np.broadcast_to(normals[:, None], d.shape)
+    n_2 = normals[idx]
+    angle_1 = (n_1 * d).sum(axis=2)
+    angle_2 = (n_2 * d).sum(axis=2)
+    swap = np.abs(angle_1) < np.abs(angle_2)
+    n_1, n_2 = np.where(swap[:, :, None], n_2, n_1), np.where(swap[:, :, None], n_1, n_2)
+    d = np.where(swap[:, :, None], -d, d)
+    phi = np.where(swap, -angle_2, angle_1)
+    v = np.cross(d, n_1)
+    v /= np.maximum(np.linalg.norm(v, axis=2), 1e-12)[:, :, None]
+    w = np.cross(n_1, v)
+    alpha = (v * n_2).sum(axis=2)
+    theta = np.arctan2((w * n_2).sum(axis=2), (n_1 * n_2).sum(axis=2))
+    return alpha, phi, theta, distance
+
+
+class FeatureAlignment:
+    # coarse global alignment, RANSAC over FPFH matches of voxel downsampled keypoints
+    bins = 11
+
+    def __init__(self, voxel=None, iterations=50000, batch_size=500, seed=0, workers=-1):
+        # voxel is 1/50 of the target size by default
+        self.voxel = voxel
+        # threads of every KDTree query, all cores by default
+        self.workers = workers
+        self.iterations = iterations
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+
+    def get_keypoints(self, pc, voxel):
+        # downsample and estimate normals, oriented away from the centroid
+        keypoints = pc.downsample(voxel)
+        kdtree = KDTree(keypoints.points)
+        normals = keypoints.estimate_normals(kdtree, workers=self.workers)
+        outward = ((keypoints.points - keypoints.get_centroid()) * normals).sum(axis=1) < 0
+        normals[outward] *= -1
+        return keypoints, kdtree
+
+    def get_features(self, pc, kdtree, radius, max_nn=50):
+        # neighbours within radius, missing ones have infinite distance
+        distance, idx = kdtree.query(pc.points, k=max_nn + 1, distance_upper_bound=radius, workers=self.workers)
+        valid = np.isfinite(distance) & (distance > 0)
+        idx = np.where(valid, idx, 0)
+        points = pc.points.astype(np.float64)
+        normals = pc.normals.astype(np.float64)
+        alpha, phi, theta, distance = get_pair_features(points, normals, idx, valid)
+
+        # simplified point feature histograms, 3 histograms of 11 bins, each summing to 100
+        count = len(points)
+        spfh = np.zeros((count, 3 * self.bins))
+        rows = np.repeat(np.arange(count), valid.sum(axis=1))
+        for i, (value, low, high) in enumerate(((alpha, -1, 1), (phi, -1, 1), (theta, -np.pi, np.pi))):
+            bins = np.clip(((value[valid] - low) / (high - low) * self.bins).astype(np.int64), 0, self.bins - 1)
+            np.add.at(spfh, (rows, i * self.bins + bins), 1)
+        spfh *= 100 / np.maximum(valid.sum(axis=1), 1)[:, None]
+
+        # fast point feature histograms add neighbours' histograms weighted by inverse distance
+        weights = np.where(valid, 1 / np.where(valid, distance, 1), 0)
+        fpfh = spfh + np.einsum('nk,nkf->nf', weights, spfh[idx]) / np.maximum(valid.sum(axis=1), 1)[:, None]
+        fpfh = fpfh.reshape(count, 3, self.bins)
+        fpfh *= 100 / np.maximum(fpfh.sum(axis=2, keepdims=True), 1e-12)
+        return fpfh.reshape(count, -1)
+
+    def get_correspondences(self, features_s, features_t):
+        # nearest features both ways, keep mutual matches when there are enough
+        _, forward = KDTree(features_t).query(features_s, workers=self.workers)
+        _, backward = KDTree(features_s).query(features_t, workers=self.workers)
+        source = np.arange(len(features_s))
+        mutual = backward[forward] == source
+        if mutual.sum() >= 10:
+            return source[mutual], forward[mutual]
+        return source, forward
+
+    def ransac(self, p, q, epsilon):
+        # hypotheses from 3 random correspondences, scored all at once by their inliers
+        best_inliers, best = -1, (np.eye(3), np.zeros(3))
+        for _ in range(0, self.iterations, self.batch_size):
+            sample = self.rng.integers(0, len(p), size=(self.batch_size, 3))
+            p_s, q_s = p[sample], q[sample]
+            # rigid motions keep edge lengths, drop samples that do not
+            edge_p = np.linalg.norm(p_s - np.roll(p_s, 1, axis=1), axis=2)
+            edge_q = np.linalg.norm(q_s - np.roll(q_s, 1, axis=1), axis=2)
+            similar = (np.minimum(edge_p, edge_q) >= 0.9 * np.maximum(edge_p, edge_q)).all(axis=1)
+            similar &= edge_p.min(axis=1) > epsilon
+            if not similar.any():
+                continue
+            R, T = kabsch(p_s[similar], q_s[similar])
+            residual = np.linalg.norm(np.einsum('bij,mj->bmi', R, p) + T[:, None] - q, axis=2)
+            inliers = (residual < epsilon).sum(axis=1)
+            i = np.argmax(inliers)
+            if inliers[i] > best_inliers:
+                best_inliers, best = inliers[i], (R[i], T[i])
+
+        # refit to all inliers of the best hypothesis
+        R, T = best
+        for _ in range(3):
+            inlier = np.linalg.norm(p.dot(R.T) + T - q, axis=1) < epsilon
+            if inlier.sum() < 3:
+                break
+            R, T = kabsch(p[inlier][None], q[inlier][None])
+            R, T = R[0], T[0]
+        return R, T, best_inliers
+
+    def align(self, pc_source, pc_target):
+        # R & T moving source onto target
+        voxel = self.voxel if self.voxel else pc_target.get_size() / 50
+        source, kdtree_s = self.get_keypoints(pc_source, voxel)
+        target, kdtree_t = self.get_keypoints(pc_target, voxel)
+        features_s = self.get_features(source, kdtree_s, 5 * voxel)
+        features_t = self.get_features(target, kdtree_t, 5 * voxel)
+        i, j = self.get_correspondences(features_s, features_t)
+        R, T, inliers = self.ransac(source.points[i].astype(np.float64), target.points[j].astype(np.float64),
+                                    1.5 * voxel)
+        print("coarse alignment: {} correspondences, {} inliers".format(len(i), inliers))
+        return R, T
@@ -1,8 +1,9 @@
 import numpy as np
 import tqdm
 import os
+import time
 from scipy.spatial import KDTree
-from mayavi import mlab
+from scipy.spatial.transform import Rotation
 
 
 class PointCloud:
@@ -14,20 +15,53 @@ class PointCloud:
     def __init__(self, path):
         if path:
             self.points = self.get_points_from_txt(path)
+        # unit normals, estimated on demand
+        self.normals = None
 
     def get_centroid(self):
         # calculate centroid
         # (x1 + x2 + x3 + ... + xn) / n
         return np.mean(self.points, axis=0)
 
+    def get_size(self):
+        # length of the bounding box diagonal
+        return np.linalg.norm(self.points.max(axis=0) - self.points.min(axis=0))
+
+    def downsample(self, voxel):
+        # one point per occupied voxel, at the centroid of its points
+        keys = np.floor(self.points / voxel).astype(np.int64)
+        _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        sums = np.stack([np.bincount(inverse, weights=self.points[:, j]) for j in range(3)], axis=1)
+        pc = PointCloud(path=None)
+        pc.points = (sums / counts[:, None]).astype(np.float32)
+        return pc
+
+    def estimate_normals(self, kdtree, k=10, chunk_size=65536, workers=-1):
+        # normal of every point is the direction of least variance of its k nearest neighbours
+        self.normals = np.empty(self.points.shape, dtype=np.float32)
+        for start in range(0, len(self.points), chunk_size):
+            points = self.points[start:start + chunk_size]
+            _, idx = kdtree.query(points, k=k, workers=workers)
+            neighbours = self.points[idx] - self.points[idx].mean(axis=1, keepdims=True)
+            covariance = np.einsum('nki,nkj->nij', neighbours, neighbours, dtype=np.float64)
+            self.normals[start:start + chunk_size] = np.linalg.eigh(covariance)[1][:, :, 0]
+        return self.normals
+
 
 class ICP:
-    def __init__(self, pc_source, pc_target, name):
+    # method 'point' minimizes distances between closest pairs by SVD,
+    # 'plane' minimizes distances to the tangent planes of the target by a linearized least squares
+    methods = ('point', 'plane')
+
+    def __init__(self, pc_source, pc_target, name, method='point'):
+        assert method in self.methods, 'unknown method {}'.format(method)
         # point cloud source & target
         self.pc_source = pc_source
         self.pc_target = pc_target
         self.pc_temp = None
         self.name = name
+        self.method = method
 
         # translation & rotation matrix
         # T = [tx, ty, tz]
@@ -38,19 +72,40 @@ class ICP:
         self.R = np.identity(3)
 
         # closest point pair & threshold
-        self.closest_pair = [-1 for _ in range(len(self.pc_source.points))]
+        self.closest_pair = np.full(len(self.pc_source.points), -1, dtype=np.int64)
+        self.distances = None
         self.threshold = 1e-5
+        # point to plane ignores pairs farther apart than rejection * median distance
+        self.rejection = 3
+        # threads of KDTree queries, -1 uses every core
+        self.workers = -1
 
-    def transformation_source_point_cloud(self):
-        # transform source point cloud
-        # according to matrix T & R
+        # KDTree of target point cloud, built once per registration
+        self.kdtree = None
+        # target points paired with temp points, preallocated like temp point cloud
+        self.pc_matched = None
+        # distance of target points to their centroid, to compare translations with
+        self.scale = np.sqrt(((self.pc_target.points - self.pc_target.get_centroid()) ** 2).sum(axis=1).mean())
+
+        # root mean square distance of closest pairs, iterations used and time spent by train
+        self.rms = None
+        self.iterations = 0
+        self.time = 0
+        # iterations of every train_pyramid level, coarsest first and the full clouds last
+        self.level_iterations = []
+
+    def get_transformation(self):
+        # 4*4 homogeneous matrix of R & T
         transformation_matrix = np.eye(4)
         transformation_matrix[0:3, 0:3] = self.R
-        transformation_matrix[0:3, 3] = self.T.reshape(1, 3)
+        transformation_matrix[0:3, 3] = self.T
+        return transformation_matrix
 
-        # homogeneous coordinates
-        pc_homogeneous = np.hstack((self.pc_temp.points, np.ones((self.pc_temp.points.shape[0], 1))))
-        self.pc_temp.points = (np.dot(transformation_matrix, pc_homogeneous.T)).T[:, :3]
+    def transformation_source_point_cloud(self):
+        # transform source point cloud into temp point cloud
+        # according to accumulated matrix T & R, in place without new arrays
+        np.matmul(self.pc_source.points, self.R.T.astype(np.float32), out=self.pc_temp.points)
+        self.pc_temp.points += self.T.astype(np.float32)
 
     def get_closest_pair(self):
         # for every point in temp point cloud,
@@ -71,62 +126,136 @@ class ICP:
     def get_closest_pair_kdtree(self):
         # for every point in temp point cloud,
         # find the closest point in target point cloud
-        # build KDTree
-        kdtree = KDTree(self.pc_target.points)
-        sum_dist = 0
-        for i in range(len(self.pc_temp.points)):
-            p_s = self.pc_temp.points[i]
-            dist, idx = kdtree.query(p_s)
-            sum_dist += dist
-            self.closest_pair[i] = idx
+        # query all points at once with every core
+        dist, self.closest_pair = self.kdtree.query(self.pc_temp.points, workers=self.workers)
+        self.rms = np.sqrt((dist ** 2).mean())
+        self.distances = dist
         # check if average distance is smaller than threshold
-        print("average distance: {}".format(sum_dist / len(self.pc_temp.points)))
-        if sum_dist / len(self.pc_temp.points) < self.threshold:
+        print("average distance: {}".format(dist.mean()))
+        if dist.mean() < self.threshold:
             return True
         else:
             return False
 
     def calculate_svd(self):
-        # H = sigma(p_s * p_t.T)
-        # H = np.zeros((3, 3))
-        centroid_s = self.pc_temp.get_centroid()
-        centroid_t = self.pc_target.get_centroid()
-
-        p_s = self.pc_temp.points - centroid_s
-        # use closest pair to construct p_t
-        p_t = np.array([self.pc_target.points[i] for i in self.closest_pair]) - centroid_t
+        # gather paired target points into the preallocated buffer
+        np.take(self.pc_target.points, self.closest_pair, axis=0, out=self.pc_matched.points)
+        centroid_s = self.pc_temp.points.mean(axis=0, dtype=np.float64)
+        centroid_t = self.pc_matched.points.mean(axis=0, dtype=np.float64)
 
-        H = p_s.T.dot(p_t)
+        # H = sigma((p_s - centroid_s) * (p_t - centroid_t).T)
+        H = np.einsum('ni,nj->ij', self.pc_temp.points, self.pc_matched.points, dtype=np.float64) - \
+            len(self.pc_temp.points) * np.outer(centroid_s, centroid_t)
         U, S, V = np.linalg.svd(H)
-        self.R = (V.T).dot(U.T)
-        self.T = centroid_t - self.R.dot(centroid_s)
+        # flip the last axis if the best orthogonal matrix is a reflection
+        D = np.diag([1, 1, np.sign(np.linalg.det((V.T).dot(U.T)))])
+        R = (V.T).dot(D).dot(U.T)
+        T = centroid_t - R.dot(centroid_s)
+        return self.add_step(R, T)
+
+    def calculate_point_to_plane(self):
+        # gather paired target points and normals
+        np.take(self.pc_target.points, self.closest_pair, axis=0, out=self.pc_matched.points)
+        normals = self.pc_target.normals[self.closest_pair]
+        centroid_s = self.pc_temp.points.mean(axis=0, dtype=np.float64)
 
-    def train(self, max_iter=10):
-        # initialize temp point cloud
+        # rotation w about centroid_s and translation t move p_s by w x (p_s - centroid_s) + t,
+        # solve the 6*6 normal equations of sigma(((p_s - p_t) . n + w . ((p_s - centroid_s) x n) + t . n)^2)
+        A = np.empty((len(normals), 6))
+        A[:, :3] = np.cross(self.pc_temp.points - centroid_s.astype(np.float32), normals)
+        A[:, 3:] = normals
+        b = ((self.pc_matched.points - self.pc_temp.points) * normals).sum(axis=1)
+        keep = self.distances <= self.rejection * np.median(self.distances)
+        # minimum norm least squares, directions the target does not constrain (sliding along a plane) get no step
+        w_t = np.linalg.lstsq(A[keep], b[keep], rcond=1e-6)[0]
+
+        R = Rotation.from_rotvec(w_t[:3]).as_matrix()
+        T = centroid_s + w_t[3:] - R.dot(centroid_s)
+        return self.add_step(R, T)
+
+    def add_step(self, R, T):
+        # accumulate the step into R & T
+        self.R = R.dot(self.R)
+        self.T = R.dot(self.T) + T
+        return R, T
+
+    def get_delta(self, R, T):
+        # size of a step, rotation angle plus translation relative to target size
+        angle = np.arccos(np.clip((np.trace(R) - 1) / 2, -1, 1))
+        return angle + np.linalg.norm(T) / self.scale
+
+    def train(self, max_iter=10, tolerance=1e-4, plot=True):
+        start = time.perf_counter()
+        # temp point cloud is a float32 buffer holding the source transformed by R & T,
+        # starting from the current R & T
         self.pc_temp = PointCloud(path=None)
-        self.pc_temp.points = self.pc_source.points.copy()
+        self.pc_temp.points = np.empty(self.pc_source.points.shape, dtype=np.float32)
+        self.pc_matched = PointCloud(path=None)
+        self.pc_matched.points = np.empty(self.pc_source.points.shape, dtype=np.float32)
+        self.transformation_source_point_cloud()
+        # the target never moves, build its KDTree once
+        self.kdtree = KDTree(self.pc_target.points)
+        # target normals are estimated once for point to plane
+        if self.method == 'plane' and self.pc_target.normals is None:
+            self.pc_target.estimate_normals(self.kdtree, workers=self.workers)
 
         # make a directory to store results
         path = "../results/{}/".format(self.name)
-        if not os.path.exists(path):
-            os.makedirs(path)
-        self.save_figure(path + self.name + "_initial.png")
+        if plot:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.save_figure(path + self.name + "_initial.png")
 
         # iteration
+        self.iterations = 0
+        previous_rms = None
         for i in tqdm.tqdm(range(max_iter)):
-            self.transformation_source_point_cloud()
+            self.iterations = i + 1
             # self.get_closest_pair()
             if self.get_closest_pair_kdtree():
                 break
-            self.calculate_svd()
-            self.save_figure(path + self.name + "_iter_{}.png".format(i))
+            R, T = self.calculate_svd() if self.method == 'point' else self.calculate_point_to_plane()
+            self.transformation_source_point_cloud()
+            if plot:
+                self.save_figure(path + self.name + "_iter_{}.png".format(i))
+            # stop when the error or the transformation hardly changes
+            if previous_rms is not None and abs(previous_rms - self.rms) <= tolerance * previous_rms:
+                break
+            if self.get_delta(R, T) <= tolerance:
+                break
+            previous_rms = self.rms
+        self.time = time.perf_counter() - start
+        print("{} iterations, rms: {}, time: {:.3f}s".format(self.iterations, self.rms, self.time))
+
+    def train_pyramid(self, levels=3, max_iter=10, tolerance=1e-4, plot=True):
+        # register voxel downsampled clouds first, the coarsest voxel is 1/50 of the target size
+        # and each finer level halves it, R & T carry over to the next level and to the full clouds
+        start = time.perf_counter()
+        voxel = self.pc_target.get_size() / 50
+        self.level_iterations = []
+        for level in range(levels - 1, 0, -1):
+            icp = ICP(self.pc_source.downsample(voxel), self.pc_target.downsample(voxel), self.name, self.method)
+            icp.workers = self.workers
+            icp.R, icp.T = self.R, self.T
+            icp.train(max_iter, tolerance, plot=False)
+            self.R, self.T = icp.R, icp.T
+            self.level_iterations.append(icp.iterations)
+            voxel /= 2
+        self.train(max_iter, tolerance, plot)
+        # iterations count every level, not only the full clouds
+        self.level_iterations.append(self.iterations)
+        self.iterations = sum(self.level_iterations)
+        self.time = time.perf_counter() - start
 
     def save_figure(self, name):
+        # import mayavi only when plotting, batch runs without figures do not need it
+        from mayavi import mlab
+
         # close screen and set size
         mlab.options.offscreen = True
         figure = mlab.figure(bgcolor=(1, 1, 1), size=(512, 512))
 
-        self.transformation_source_point_cloud()
+        # temp point cloud is already transformed by R & T
         point_cloud_np1 = self.pc_temp.points
         point_cloud_np2 = self.pc_target.points
 
@@ -1,10 +1,15 @@
 from icp import *
+from coarse import FeatureAlignment
 
 max_iteration = 10
+coarse_alignment = True
 
 if __name__ == '__main__':
     for i in range(1, 10):
         pc1 = PointCloud(path="../assets/{}_A.txt".format(i))
         pc2 = PointCloud(path="../assets/{}_B.txt".format(i))
         icp = ICP(pc1, pc2, name="{}".format(i))
+        if coarse_alignment:
+            # seed R & T with a global alignment, fine ICP only refines it
+            icp.R, icp.T = FeatureAlignment().align(pc1, pc2)
         icp.train(max_iter=max_iteration)
@@ -0,0 +1,90 @@
+import os
+import glob
+import hashlib
+import argparse
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from slic import Image, SLIC
+from output import SnapshotWriter
+
+image_extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+class LabCache:
+    def __init__(self, directory: str):
+        # lab arrays are stored as <content hash>.npy in directory
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def get_key(path, chunk_size=1 << 20):
+        # hash file content, so renamed or copied images share one entry
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def load(self, path, key=None):
+        # load lab array from cache, convert and store it on a miss
+        cache_path = os.path.join(self.directory, '{}.npy'.format(key if key else self.get_key(path)))
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+        image_lab = Image.open(path)
+        # write to a temporary file first, so concurrent workers never read a partial entry
+        temp_path = '{}.{}.tmp.npy'.format(cache_path[:-4], os.getpid())
+        np.save(temp_path, image_lab)
+        os.replace(temp_path, cache_path)
+        return image_lab
+
+
+def get_paths(pattern):
+    # a directory means every image in it, otherwise pattern is a glob
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*')
+    return sorted(path for path in glob.glob(pattern) if path.lower().endswith(image_extensions))
+
+
+def warm_cache(path, cache_directory):
+    # decode and convert an image once before jobs on it start
+    LabCache(cache_directory).load(path)
+    return path
+
+
+def run_job(path, k, m, iterations, cache_directory, mode='image', every=0):
+    # segment one image with one parameter set
+    key = LabCache.get_key(path)
+    image = Image()
+    # results are named by content hash too, so equal file names in different folders do not collide
+    name = '{}_{}'.format(os.path.splitext(os.path.basename(path))[0], key[:8])
+    image.set_data(LabCache(cache_directory).load(path, key), name)
+    SLIC(image, k, m).train(iterations, writer=SnapshotWriter(mode=mode, every=every))
+    return path, k, m
+
+
+def run_batch(pattern, ks, ms, iterations, cache_directory='../cache', workers=None, mode='image', every=0):
+    paths = get_paths(pattern)
+    jobs = list(itertools.product(paths, ks, ms))
+    print('Batch of {} images, {} jobs'.format(len(paths), len(jobs)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # fill cache first, so each image is converted once however many jobs use it
+        list(executor.map(warm_cache, paths, itertools.repeat(cache_directory)))
+        futures = [executor.submit(run_job, path, k, m, iterations, cache_directory, mode, every)
+                   for path, k, m in jobs]
+        return [future.result() for future in futures]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run SLIC over a directory or glob of images.')
+    parser.add_argument('pattern', help='image directory or glob pattern')
+    parser.add_argument('--k', type=int, nargs='+', default=[100], help='numbers of clusters')
+    parser.add_argument('--m', type=float, nargs='+', default=[0.2], help='weights between color and space')
+    parser.add_argument('--iterations', type=int, default=10, help='number of algorithm iterations')
+    parser.add_argument('--cache', default='../cache', help='directory of cached lab arrays')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--mode', choices=SnapshotWriter.modes, default='image', help='what every snapshot saves')
+    parser.add_argument('--every', type=int, default=0, help='save every N iterations, 0 saves only the final one')
+    args = parser.parse_args()
+    run_batch(args.pattern, args.k, args.m, args.iterations, args.cache, args.workers, args.mode, args.every)
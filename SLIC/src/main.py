@@ -4,9 +4,11 @@ image_path = Image("../assets/lenna.png")
 k = 100
 m = 0.2
 iteration_time = 10
+tolerance = 0.5
+writer = SnapshotWriter(mode='image', every=1)
 
 
 if __name__ == '__main__':
-    SLIC(image_path, k, m).train(iteration_time)
+    SLIC(image_path, k, m).train(iteration_time, tolerance, writer)
 
 
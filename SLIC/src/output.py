@@ -0,0 +1,73 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from skimage import io, color, segmentation
+
+
+def render(image_lab, labels, colors):
+    # paint every assigned pixel with its cluster's color into a new lab image
+    rendered = image_lab.copy()
+    assigned = labels >= 0
+    rendered[assigned] = colors[labels[assigned]]
+    return rendered
+
+
+def save_lab(path, image_lab):
+    # save lab image as rgb, rescales 0-1 to 0-255
+    image_rgb = color.lab2rgb(image_lab)
+    io.imsave(path, (image_rgb * 255).astype(np.uint8), check_contrast=False)
+
+
+def save_boundaries(path, image_lab, labels):
+    # draw superpixel boundaries over the original image
+    image_rgb = segmentation.mark_boundaries(color.lab2rgb(image_lab), labels)
+    io.imsave(path, (image_rgb * 255).astype(np.uint8), check_contrast=False)
+
+
+class SnapshotWriter:
+    # mode 'image' saves mean colored images, 'labels' saves label maps as .npy,
+    # 'boundaries' saves boundary overlays on the original image
+    modes = ('image', 'labels', 'boundaries')
+
+    def __init__(self, mode: str = 'image', every: int = 1, workers: int = 1, prefix: str = None):
+        # every N iterations, or only the final one when every is 0
+        assert mode in self.modes, 'unknown mode {}'.format(mode)
+        self.mode = mode
+        self.every = every
+        self.workers = workers
+        # file names are prefix followed by iteration
+        self.prefix = prefix if prefix else 'Boundaries' if mode == 'boundaries' else 'Iteration'
+        self.directory = None
+        self.executor = None
+        self.futures = []
+
+    def open(self, directory):
+        # start background writer
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.futures = []
+
+    def submit(self, iteration, image_lab, labels, colors, final=False):
+        # skip iterations that are not selected
+        if not final and (self.every == 0 or iteration % self.every != 0):
+            return
+        # raise errors of finished writes early and forget them
+        for future in [future for future in self.futures if future.done()]:
+            future.result()
+            self.futures.remove(future)
+        # copy state that keeps changing on the training thread, encode and write in background
+        labels = labels.copy()
+        colors = colors.copy()
+        path = '{}/{}{}'.format(self.directory, self.prefix, iteration)
+        if self.mode == 'image':
+            self.futures.append(self.executor.submit(lambda: save_lab(path + '.png', render(image_lab, labels, colors))))
+        elif self.mode == 'labels':
+            self.futures.append(self.executor.submit(np.save, path + '.npy', labels))
+        else:
+            self.futures.append(self.executor.submit(save_boundaries, path + '.png', image_lab, labels))
+
+    def close(self):
+        # wait for pending writes and raise their errors
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        self.futures = []
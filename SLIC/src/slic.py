@@ -1,7 +1,9 @@
 import os
+import time
 import tqdm
 import numpy as np
-from skimage import io, color
+from skimage import io, color, measure
+from output import SnapshotWriter, save_lab
 
 
 class Image:
@@ -12,11 +14,16 @@ class Image:
         image_lab = color.rgb2lab(image_rgb)
         return image_lab
 
-    def __init__(self, path):
-        # open image
-        self.data = self.open(path)
-        # record name
-        self.name = os.path.splitext(os.path.basename(path))[0]
+    def __init__(self, path=None):
+        if path:
+            # open image and record name
+            self.set_data(self.open(path), os.path.splitext(os.path.basename(path))[0])
+
+    def set_data(self, data, name):
+        # set lab data and name
+        self.data = data
+        self.name = name
+        self.gradient = None
         # record height and width
         self.height = self.data.shape[0]
         self.width = self.data.shape[1]
@@ -25,20 +32,24 @@ class Image:
         # get lab value at x,y
         return self.data[x, y, :]
 
+    @staticmethod
+    def get_gradients(data):
+        # calculate lab gradient magnitude of every pixel in (..., height, width, 3) data
+        # borders repeat their nearest pixel instead of reading 0
+        padded = np.pad(data, [(0, 0)] * (data.ndim - 3) + [(1, 1), (1, 1), (0, 0)], mode='edge')
+        gradient_x = ((padded[..., :-2, 1:-1, :] - padded[..., 2:, 1:-1, :]) ** 2).sum(axis=-1)
+        gradient_y = ((padded[..., 1:-1, :-2, :] - padded[..., 1:-1, 2:, :]) ** 2).sum(axis=-1)
+        return np.sqrt(gradient_x + gradient_y)
+
+    def get_gradient_map(self):
+        # calculate gradient map once and share it between stages
+        if self.gradient is None:
+            self.gradient = self.get_gradients(self.data)
+        return self.gradient
+
     def get_gradient(self, x, y):
-        # get gradient at x_l,x_r,y_u,y_d
-        gradient_x_l = self.get_lab(x - 1, y) if x - 1 >= 0 else 0
-        gradient_x_r = self.get_lab(x + 1, y) if x + 1 < self.width else 0
-        gradient_y_u = self.get_lab(x, y - 1) if y - 1 >= 0 else 0
-        gradient_y_d = self.get_lab(x, y + 1) if y + 1 < self.height else 0
-        # calculate gradient on x,y axis
-        gradient_x = (gradient_x_l[0] - gradient_x_r[0]) ** 2 +\
-                     (gradient_x_l[1] - gradient_x_r[1]) ** 2 +\
-                     (gradient_x_l[2] - gradient_x_r[2]) ** 2
-        gradient_y = (gradient_y_u[0] - gradient_y_d[0]) ** 2 +\
-                     (gradient_y_u[1] - gradient_y_d[1]) ** 2 +\
-                     (gradient_y_u[2] - gradient_y_d[2]) ** 2
-        return (gradient_x + gradient_y) ** 0.5
+        # get gradient at x,y
+        return self.get_gradient_map()[x, y]
 
     def get_distance(self, x, y, pixel):
         # get distance between pixel[x][y] and another pixel
@@ -47,19 +58,26 @@ class Image:
         distance_xy = ((x - pixel.x) ** 2 + (y - pixel.y) ** 2) ** 0.5
         return distance_lab, distance_xy
 
+    def get_window_distance(self, x_min, x_max, y_min, y_max, pixel):
+        # get squared distances between every pixel in window and another pixel
+        window = self.data[x_min:x_max, y_min:y_max, :]
+        distance_lab = ((window[:, :, 0] - pixel.cie_l) ** 2 +
+                        (window[:, :, 1] - pixel.cie_a) ** 2 +
+                        (window[:, :, 2] - pixel.cie_b) ** 2)
+        # coordinates broadcast as a column and a row instead of a full grid
+        x, y = np.ogrid[x_min:x_max, y_min:y_max]
+        distance_xy = (x - pixel.x) ** 2 + (y - pixel.y) ** 2
+        return distance_lab, distance_xy
+
     def save(self, path):
         # save lab image as rgb
-        image_rgb = color.lab2rgb(self.data)
-        # rescales 0-1 to 0-255
-        image_rgb_255 = (image_rgb * 255).astype(np.uint8)
-        io.imsave(path, image_rgb_255)
+        save_lab(path, self.data)
 
 
 class Cluster:
     def __init__(self, cid, x, y, cie_l=0, cie_a=0, cie_b=0):
-        # a cluster has a center pixel and a list of pixels
+        # a cluster has a center pixel, its pixels are given by the label map
         self.set(cid, x, y, cie_l, cie_a, cie_b)
-        self.pixels = []
 
     def set(self, cid, x, y, cie_l, cie_a, cie_b):
         # set id and x,y and l,a,b
@@ -72,96 +90,184 @@ class Cluster:
 
 
 class SLIC:
-    def __init__(self, image: Image, k: int, m: float):
+    def __init__(self, image: Image, k: int, m: float, s: int = None):
         # set image and k,m and n,s
         self.image = image
         self.k = k
         self.m = m
         self.n = self.image.height * self.image.width
-        self.s = int((self.n / self.k) ** 0.5)
+        # step size can be given when image is a part of a larger one
+        self.s = s if s else int((self.n / self.k) ** 0.5)
         # set clusters and labels and distances
         self.clusters = []
-        self.labels = [[-1 for _ in range(self.image.height)] for _ in range(self.image.width)]
-        self.distances = [[1e9 for _ in range(self.image.height)] for _ in range(self.image.width)]
+        self.labels = np.full((self.image.height, self.image.width), -1, dtype=np.int32)
+        self.distances = np.full((self.image.height, self.image.width), 1e9)
+        # record residual of every iteration
+        self.residuals = []
+        # record runtime of connectivity enforcement
+        self.connectivity_time = 0.0
 
     def initialize_clusters(self):
         # iterate through image by step size
-        for x in range(self.s // 2, self.image.width, self.s):
-            for y in range(self.s // 2, self.image.height, self.s):
+        for x in range(self.s // 2, self.image.height, self.s):
+            for y in range(self.s // 2, self.image.width, self.s):
                 # create cluster
                 cie_l, cie_a, cie_b = self.image.get_lab(x, y)
                 cluster = Cluster(len(self.clusters), x, y, cie_l, cie_a, cie_b)
                 self.clusters.append(cluster)
 
+    @staticmethod
+    def get_lowest_gradient(gradients):
+        # get offset of the lowest gradient in every 3*3 neighbourhood, center is kept on ties
+        gradients = gradients.reshape(len(gradients), 9)
+        lowest = np.argmin(gradients, axis=1)
+        lowest[gradients[:, 4] <= gradients[np.arange(len(gradients)), lowest]] = 4
+        return lowest // 3 - 1, lowest % 3 - 1
+
     def adjust_clusters(self):
-        for cluster in self.clusters:
-            # calculate 9 pixels' gradients around each center
-            old_gradient = self.image.get_gradient(cluster.x, cluster.y)
-            for x in range(cluster.x - 1, cluster.x + 2):
-                for y in range(cluster.y - 1, cluster.y + 2):
-                    new_gradient = self.image.get_gradient(x, y)
-                    # update cluster if gradient is smaller
-                    if new_gradient < old_gradient:
-                        cie_l, cie_a, cie_b = self.image.get_lab(x, y)
-                        cluster.set(cluster.cid, x, y, cie_l, cie_a, cie_b)
+        # gather 3*3 gradients around every center at once
+        x = np.array([cluster.x for cluster in self.clusters])
+        y = np.array([cluster.y for cluster in self.clusters])
+        offsets = np.arange(-1, 2)
+        neighbour_x = np.clip(x[:, None, None] + offsets[:, None], 0, self.image.height - 1)
+        neighbour_y = np.clip(y[:, None, None] + offsets, 0, self.image.width - 1)
+        offset_x, offset_y = self.get_lowest_gradient(self.image.get_gradient_map()[neighbour_x, neighbour_y])
+        # move centers to their lowest gradient neighbour
+        new_x = np.clip(x + offset_x, 0, self.image.height - 1)
+        new_y = np.clip(y + offset_y, 0, self.image.width - 1)
+        for cluster, x, y in zip(self.clusters, new_x, new_y):
+            cie_l, cie_a, cie_b = self.image.get_lab(x, y)
+            cluster.set(cluster.cid, int(x), int(y), cie_l, cie_a, cie_b)
+
+    def get_window(self, cluster):
+        # clip 2S*2S window around cluster to image bound
+        x_min, x_max = max(cluster.x - 2 * self.s, 0), min(cluster.x + 2 * self.s, self.image.height)
+        y_min, y_max = max(cluster.y - 2 * self.s, 0), min(cluster.y + 2 * self.s, self.image.width)
+        return x_min, x_max, y_min, y_max
 
     def update_labels(self):
         for cluster in self.clusters:
-            # iterate through 2S*2S pixels in cluster
-            for x in range(cluster.x - 2 * self.s, cluster.x + 2 * self.s):
-                for y in range(cluster.y - 2 * self.s, cluster.y + 2 * self.s):
-                    # skip if out of bound
-                    if x < 0 or x >= self.image.width or y < 0 or y >= self.image.height:
-                        continue
-                    # update label if distance is smaller
-                    dist_lab, dist_xy = self.image.get_distance(x, y, cluster)
-                    dist = (dist_lab ** 2 + self.m * dist_xy ** 2) ** 0.5
-                    if dist < self.distances[x][y]:
-                        # update cluster's pixels
-                        if self.labels[x][y] != -1:
-                            self.clusters[self.labels[x][y]].pixels.remove((x, y))
-                        # update distance and label
-                        self.labels[x][y] = cluster.cid
-                        self.distances[x][y] = dist
-                        cluster.pixels.append((x, y))
+            x_min, x_max, y_min, y_max = self.get_window(cluster)
+            # compute distances of the whole window at once
+            dist_lab, dist_xy = self.image.get_window_distance(x_min, x_max, y_min, y_max, cluster)
+            dist = np.sqrt(dist_lab + self.m * dist_xy)
+            # update label and distance where distance is smaller
+            labels = self.labels[x_min:x_max, y_min:y_max]
+            distances = self.distances[x_min:x_max, y_min:y_max]
+            closer = dist < distances
+            labels[closer] = cluster.cid
+            distances[closer] = dist[closer]
+
+    def get_centers(self):
+        # get x,y,l,a,b of every cluster as an array
+        return np.array([(cluster.x, cluster.y, cluster.cie_l, cluster.cie_a, cluster.cie_b)
+                         for cluster in self.clusters], dtype=np.float64)
+
+    def iterate(self):
+        # update labels of every window from scratch
+        centers = self.get_centers()
+        self.labels.fill(-1)
+        self.distances.fill(1e9)
+        self.update_labels()
+        # update clusters and record how far centers moved
+        self.update_clusters()
+        residual = float(np.sqrt(((self.get_centers()[:, :2] - centers[:, :2]) ** 2).sum(axis=1)).mean())
+        self.residuals.append(residual)
+        return residual
+
+    def get_sums(self):
+        # sum count,x,y,l,a,b of every cluster's pixels by label
+        assigned = self.labels >= 0
+        labels = self.labels[assigned]
+        x, y = np.nonzero(assigned)
+        lab = self.image.data[assigned]
+        length = len(self.clusters)
+        count = np.bincount(labels, minlength=length)
+        sums = [np.bincount(labels, weights=weights, minlength=length)
+                for weights in (x, y, lab[:, 0], lab[:, 1], lab[:, 2])]
+        return count, sums
 
     def update_clusters(self):
+        count, (sum_x, sum_y, sum_l, sum_a, sum_b) = self.get_sums()
         for cluster in self.clusters:
-            # update new center
-            sum_x = sum_y = count = 0
-            for pixel in cluster.pixels:
-                sum_x += pixel[0]
-                sum_y += pixel[1]
-                count += 1
+            # keep center of a cluster without pixels
+            n = count[cluster.cid]
+            if n == 0:
+                continue
             # x,y is calculated by average of pixels
-            new_x = sum_x // count
-            new_y = sum_y // count
-            cie_l, cie_a, cie_b = self.image.get_lab(new_x, new_y)
+            new_x = int(sum_x[cluster.cid]) // n
+            new_y = int(sum_y[cluster.cid]) // n
+            # l,a,b is calculated by average of pixels
+            cie_l = sum_l[cluster.cid] / n
+            cie_a = sum_a[cluster.cid] / n
+            cie_b = sum_b[cluster.cid] / n
             cluster.set(cluster.cid, new_x, new_y, cie_l, cie_a, cie_b)
 
-    def update_image(self, path: str):
-        image_lab = self.image.data
-        for cluster in self.clusters:
-            # set pixels to cluster's color
-            for pixel in cluster.pixels:
-                image_lab[pixel[0], pixel[1], :] = cluster.cie_l, cluster.cie_a, cluster.cie_b
-        # save image
-        self.image.data = image_lab
-        self.image.save(path)
-
-    def train(self, iterations: int):
+    def enforce_connectivity(self, min_size: int = None):
+        start = time.perf_counter()
+        # fragments smaller than a quarter of S*S are merged even if they are the largest part
+        min_size = self.s * self.s // 4 if min_size is None else min_size
+        # label 4-connected components of equal labels in one linear pass
+        components = measure.label(self.labels, background=-2, connectivity=1) - 1
+        count = components.max() + 1
+        sizes = np.bincount(components.ravel(), minlength=count)
+        owners = np.zeros(count, dtype=self.labels.dtype)
+        owners[components.ravel()] = self.labels.ravel()
+        # keep the largest component of every superpixel
+        order = np.lexsort((sizes, owners))
+        largest = np.append(owners[order][1:] != owners[order][:-1], True)
+        keep = np.zeros(count, dtype=bool)
+        keep[order[largest]] = True
+        keep &= (sizes >= min_size) & (owners >= 0)
+        # count shared border of every pair of touching components
+        pairs = np.concatenate((components[:, :-1].ravel() * count + components[:, 1:].ravel(),
+                                components[:-1, :].ravel() * count + components[1:, :].ravel()))
+        pairs = pairs[pairs // count != pairs % count]
+        pairs = np.concatenate((pairs, pairs % count * count + pairs // count))
+        pairs, borders = np.unique(pairs, return_counts=True)
+        sources, targets = pairs // count, pairs % count
+        # merge orphans into the kept neighbour with the longest border, grow until none is left
+        merged = 0
+        while True:
+            candidates = np.flatnonzero(~keep[sources] & keep[targets])
+            if len(candidates) == 0:
+                break
+            candidates = candidates[np.lexsort((-borders[candidates], sources[candidates]))]
+            orphans, first = np.unique(sources[candidates], return_index=True)
+            owners[orphans] = owners[targets[candidates[first]]]
+            keep[orphans] = True
+            merged += len(orphans)
+        self.labels = owners[components]
+        # colors and centers follow the merged labels
+        self.update_clusters()
+        self.connectivity_time = time.perf_counter() - start
+        print('Connectivity: merged {} fragments in {:.3f}s'.format(merged, self.connectivity_time))
+
+    def train(self, iterations: int, tolerance: float = 0.0, writer: SnapshotWriter = None):
         # create directory
         train_name = '{n}_K{k}_M{m}'.format(n=self.image.name, k=self.k, m=self.m)
         print('Training {} Start!'.format(train_name))
         directory = f'../results/{train_name}'
         if not os.path.exists(directory):
             os.makedirs(directory)
+        # write an image every iteration by default
+        writer = writer if writer else SnapshotWriter()
+        writer.open(directory)
         # initialize clusters and adjust by gradients
         self.initialize_clusters()
         self.adjust_clusters()
-        for _ in tqdm.tqdm(range(iterations)):
+        iteration = 0
+        for iteration in tqdm.tqdm(range(1, iterations + 1)):
             # update labels and clusters
-            self.update_labels()
-            self.update_clusters()
-            # update image every iteration
-            self.update_image('{}/Iteration{}.png'.format(directory, _ + 1))
+            residual = self.iterate()
+            # stop once centers move less than tolerance on average
+            if residual <= tolerance:
+                print('Converged after {} iterations, residual {:.4f}'.format(iteration, residual))
+                break
+            # hand snapshot to writer, the image itself is never modified
+            if iteration < iterations:
+                writer.submit(iteration, self.image.data, self.labels, self.get_centers()[:, 2:])
+        # merge disconnected fragments before the final snapshot
+        self.enforce_connectivity()
+        writer.submit(iteration, self.image.data, self.labels, self.get_centers()[:, 2:], final=True)
+        writer.close()
@@ -0,0 +1,93 @@
+import os
+import glob
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from skimage import color
+from slic import Image, Cluster, SLIC
+from output import SnapshotWriter
+
+
+def read_frames(pattern):
+    # yield frame paths in order, they are decoded by the convert stage
+    for path in sorted(glob.glob(pattern)):
+        yield path
+
+
+def convert(frame):
+    # decode a frame given by path and convert it to LAB
+    return Image.open(frame) if isinstance(frame, str) else color.rgb2lab(frame)
+
+
+class StreamingSLIC:
+    def __init__(self, k: int, m: float, iterations: int = 2, prefetch: int = 4, workers: int = 2,
+                 connectivity: bool = False):
+        # set k,m and refinement iterations of every frame
+        self.k = k
+        self.m = m
+        self.iterations = iterations
+        # frames decoded and converted ahead of clustering
+        self.prefetch = prefetch
+        self.workers = workers
+        self.connectivity = connectivity
+        # centers of the previous frame as rows of x,y,l,a,b, and its height and width
+        self.centers = None
+        self.shape = None
+
+    @staticmethod
+    def read(frames, executor, pending):
+        # decode and convert ahead of clustering, bounded by the size of pending
+        try:
+            for frame in frames:
+                pending.put(executor.submit(convert, frame))
+        except Exception as error:
+            failed = Future()
+            failed.set_exception(error)
+            pending.put(failed)
+        finally:
+            pending.put(None)
+
+    def segment(self, image: Image):
+        slic = SLIC(image, self.k, self.m)
+        if self.centers is None or self.shape != (image.height, image.width):
+            # start from a fresh grid on the first frame or when frame size changes
+            slic.initialize_clusters()
+            slic.adjust_clusters()
+        else:
+            # start from the previous frame's centers
+            for cid, (x, y, cie_l, cie_a, cie_b) in enumerate(self.centers):
+                slic.clusters.append(Cluster(cid, int(x), int(y), cie_l, cie_a, cie_b))
+        for _ in range(self.iterations):
+            slic.iterate()
+        if self.connectivity:
+            slic.enforce_connectivity()
+        self.centers = slic.get_centers()
+        self.shape = (image.height, image.width)
+        return slic
+
+    def process(self, frames, writer: SnapshotWriter = None, name: str = 'stream'):
+        # create directory for snapshots
+        if writer:
+            directory = '../results/{n}_K{k}_M{m}_stream'.format(n=name, k=self.k, m=self.m)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            writer.open(directory)
+        # decode and convert on worker threads, cluster here, write on writer threads
+        pending = queue.Queue(maxsize=self.prefetch)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            reader = threading.Thread(target=self.read, args=(frames, executor, pending), daemon=True)
+            reader.start()
+            index = 0
+            while True:
+                future = pending.get()
+                if future is None:
+                    break
+                index += 1
+                image = Image()
+                image.set_data(future.result(), '{}{}'.format(name, index))
+                slic = self.segment(image)
+                if writer:
+                    writer.submit(index, image.data, slic.labels, self.centers[:, 2:])
+                yield slic
+        if writer:
+            writer.close()
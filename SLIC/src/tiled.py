@@ -0,0 +1,134 @@
+import os
+import tqdm
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from skimage import io, color
+from slic import Image, Cluster, SLIC
+
+
+def convert_to_lab(path, source_path, strip=1024):
+    # convert image to LAB strip by strip into a memory-mapped file
+    image_rgb = io.imread(path)
+    height, width = image_rgb.shape[:2]
+    source = np.lib.format.open_memmap(source_path, mode='w+', dtype=np.float64, shape=(height, width, 3))
+    for x in range(0, height, strip):
+        source[x:x + strip] = color.rgb2lab(image_rgb[x:x + strip])
+    source.flush()
+    return height, width
+
+
+def segment_tile(source_path, labels_path, core, centers, s, m):
+    # core is (x_min, x_max, y_min, y_max) of the tile, centers are rows of (global id, x, y, l, a, b)
+    # of every cluster whose window can reach the core
+    source = np.load(source_path, mmap_mode='r')
+    height, width = source.shape[:2]
+    x_min, x_max, y_min, y_max = core
+    # read tile with a 2S halo so every core pixel sees all clusters that can reach it
+    halo_x_min, halo_x_max = max(x_min - 2 * s, 0), min(x_max + 2 * s, height)
+    halo_y_min, halo_y_max = max(y_min - 2 * s, 0), min(y_max + 2 * s, width)
+    image = Image()
+    image.set_data(np.asarray(source[halo_x_min:halo_x_max, halo_y_min:halo_y_max]), '{}_{}'.format(x_min, y_min))
+    # create clusters in tile coordinates
+    slic = SLIC(image, len(centers), m, s)
+    for cid, (_, x, y, cie_l, cie_a, cie_b) in enumerate(centers):
+        slic.clusters.append(Cluster(cid, int(x) - halo_x_min, int(y) - halo_y_min, cie_l, cie_a, cie_b))
+    slic.update_labels()
+    # only core pixels belong to this tile, the halo belongs to its neighbours
+    inside = np.zeros_like(slic.labels, dtype=bool)
+    inside[x_min - halo_x_min:x_max - halo_x_min, y_min - halo_y_min:y_max - halo_y_min] = True
+    slic.labels[~inside] = -1
+    # write core labels back as global ids, so labels agree across tile borders
+    ids = centers[:, 0].astype(np.int64)
+    local = slic.labels[inside].reshape(x_max - x_min, y_max - y_min)
+    labels = np.load(labels_path, mmap_mode='r+')
+    labels[x_min:x_max, y_min:y_max] = np.where(local >= 0, ids[np.maximum(local, 0)], -1)
+    labels.flush()
+    # sums of count,x,y,l,a,b of core pixels by global id, x,y in image coordinates
+    count, (sum_x, sum_y, sum_l, sum_a, sum_b) = slic.get_sums()
+    return ids, np.column_stack((count, sum_x + count * halo_x_min, sum_y + count * halo_y_min, sum_l, sum_a, sum_b))
+
+
+class TiledSLIC:
+    def __init__(self, path: str, k: int, m: float, tile_size: int = 2048, workers: int = None):
+        # set source path and k,m and tiling
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.k = k
+        self.m = m
+        self.tile_size = tile_size
+        self.workers = workers
+
+    def get_seeds(self, height, width, s):
+        # seeds on the global grid, global id is the position in the grid
+        x, y = np.meshgrid(np.arange(s // 2, height, s), np.arange(s // 2, width, s), indexing='ij')
+        return np.column_stack((np.arange(x.size), x.ravel(), y.ravel()))
+
+    @staticmethod
+    def adjust_seeds(source, seeds, chunk_size=65536):
+        # move seeds to their lowest gradient neighbour, reading only a 5*5 patch around each
+        height, width = source.shape[:2]
+        offsets = np.arange(-2, 3)
+        for start in range(0, len(seeds), chunk_size):
+            x, y = seeds[start:start + chunk_size, 1], seeds[start:start + chunk_size, 2]
+            patch_x = np.clip(x[:, None, None] + offsets[:, None], 0, height - 1)
+            patch_y = np.clip(y[:, None, None] + offsets, 0, width - 1)
+            patches = np.asarray(source[patch_x, patch_y], dtype=np.float64)
+            # inner 3*3 gradients only need pixels inside the patch, neighbours outside the image are
+            # clipped onto its border like in SLIC.adjust_clusters
+            inner_x = np.clip(x[:, None] + offsets[1:-1], 0, height - 1) - x[:, None] + 2
+            inner_y = np.clip(y[:, None] + offsets[1:-1], 0, width - 1) - y[:, None] + 2
+            gradients = Image.get_gradients(patches)[np.arange(len(x))[:, None, None], inner_x[:, :, None],
+                                                     inner_y[:, None, :]]
+            offset_x, offset_y = SLIC.get_lowest_gradient(gradients)
+            seeds[start:start + chunk_size, 1] = np.clip(x + offset_x, 0, height - 1)
+            seeds[start:start + chunk_size, 2] = np.clip(y + offset_y, 0, width - 1)
+        return seeds
+
+    def get_tiles(self, height, width):
+        # split image into tiles
+        return [(x_min, min(x_min + self.tile_size, height), y_min, min(y_min + self.tile_size, width))
+                for x_min in range(0, height, self.tile_size) for y_min in range(0, width, self.tile_size)]
+
+    @staticmethod
+    def get_reaching(centers, core, s):
+        # pick clusters inside the core's 2S halo, only their windows can reach the core
+        x_min, x_max, y_min, y_max = core
+        inside = (centers[:, 1] >= x_min - 2 * s) & (centers[:, 1] < x_max + 2 * s) &\
+                 (centers[:, 2] >= y_min - 2 * s) & (centers[:, 2] < y_max + 2 * s)
+        return centers[inside]
+
+    def train(self, iterations: int):
+        # create directory
+        train_name = '{n}_K{k}_M{m}_tiled'.format(n=self.name, k=self.k, m=self.m)
+        print('Training {} Start!'.format(train_name))
+        directory = f'../results/{train_name}'
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # convert source once, workers only read their own tiles from it
+        source_path = '{}/lab.npy'.format(directory)
+        labels_path = '{}/labels.npy'.format(directory)
+        height, width = convert_to_lab(self.path, source_path)
+        labels = np.lib.format.open_memmap(labels_path, mode='w+', dtype=np.int32, shape=(height, width))
+        labels.flush()
+        # seeds on the global grid by global step size, centers are rows of (global id, x, y, l, a, b)
+        s = int((height * width / self.k) ** 0.5)
+        source = np.load(source_path, mmap_mode='r')
+        seeds = self.adjust_seeds(source, self.get_seeds(height, width, s))
+        centers = np.column_stack((seeds, source[seeds[:, 1], seeds[:, 2]])).astype(np.float64)
+        tiles = self.get_tiles(height, width)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for _ in tqdm.tqdm(range(iterations)):
+                # label every tile with the current centers of all clusters
+                futures = [executor.submit(segment_tile, source_path, labels_path, core,
+                                           self.get_reaching(centers, core, s), s, self.m) for core in tiles]
+                # reduce sums of every cluster over all tiles, a cluster near a border is shared by several
+                sums = np.zeros((len(centers), 6))
+                for future in as_completed(futures):
+                    ids, tile_sums = future.result()
+                    sums[ids] += tile_sums
+                # update centers like SLIC.update_clusters, clusters without pixels keep their center
+                count = sums[:, 0]
+                kept = count > 0
+                centers[kept, 1:3] = np.floor_divide(sums[kept, 1:3], count[kept, None])
+                centers[kept, 3:] = sums[kept, 3:] / count[kept, None]
+        return np.load(labels_path, mmap_mode='r')
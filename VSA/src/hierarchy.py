@@ -0,0 +1,102 @@
+import numpy as np
+from obj import OBJ
+from vsa import VSA, Proxy
+
+
+class CoarseVSA(VSA):
+    # VSA over patches of triangles, errors and proxies use the summed statistics of each patch
+    def __init__(self, model: OBJ, k: int, metric: str = 'L21'):
+        super().__init__(model, k, metric)
+        self.weighted_normals = self.model.weighted_normals
+
+    def get_moments(self):
+        return self.model.moments
+
+    def get_errors(self, tids, n, x):
+        # sum of the triangle errors of every patch, without visiting its triangles
+        areas = self.model.areas[tids]
+        n = np.broadcast_to(n, (len(tids), 3))
+        if self.metric == 'L21':
+            # sum of a * |n_t - n|^2 is 2a - 2 * n . sum of a * n_t for unit normals
+            errors = 2 * areas - 2 * (self.weighted_normals[tids] * n).sum(axis=1)
+        else:
+            # integral of (n . p - n . x)^2 from the second moment, first moment and area
+            offset = (n * x).sum(axis=-1)
+            errors = np.einsum('ti,tij,tj->t', n, self.moments[tids], n) - \
+                2 * offset * (self.weighted_centroids[tids] * n).sum(axis=1) + areas * offset ** 2
+        return np.maximum(errors, 0)
+
+
+class HierarchicalVSA:
+    # partition patches of triangles first, then refine the projected partition on the triangles
+    def __init__(self, model: OBJ, k: int, metric: str = 'L21', patch_count: int = None):
+        self.model = model
+        self.k = k
+        self.metric = metric
+        # about 20 patches per proxy by default
+        self.patch_count = patch_count if patch_count else 20 * k
+        assert self.patch_count >= k, 'fewer patches than proxies'
+        # VSA on the triangles, also provides the per triangle statistics to sum
+        self.vsa = VSA(model, k, metric)
+
+    def get_patches(self):
+        # put centroids in a voxel grid sized so that about patch_count voxels hold triangles
+        centroids = self.model.centroids
+        voxel = np.sqrt(self.model.areas.sum() / self.patch_count)
+        cells = np.floor((centroids - centroids.min(axis=0)) / voxel).astype(np.int64)
+        cells = np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+        # split every voxel into connected components, keep edges inside a voxel only
+        sources, targets = self.model.get_adjacent_pairs()
+        inside = cells[sources] == cells[targets]
+        sources, targets = sources[inside], targets[inside]
+        # label every triangle with the lowest triangle id of its component
+        patches = np.arange(len(centroids))
+        while True:
+            lowest = patches.copy()
+            np.minimum.at(lowest, sources, patches[targets])
+            # the lowest id is in the same component, so jump to its label as well
+            lowest = lowest[lowest]
+            if (lowest == patches).all():
+                break
+            patches = lowest
+        return np.unique(patches, return_inverse=True)[1]
+
+    def get_coarse_model(self, patches):
+        # sum triangle statistics per patch
+        count = patches.max() + 1
+
+        def accumulate(values):
+            flat = values.reshape(len(values), -1)
+            sums = [np.bincount(patches, weights=flat[:, j], minlength=count) for j in range(flat.shape[1])]
+            return np.stack(sums, axis=1).reshape((count,) + values.shape[1:])
+
+        coarse = OBJ()
+        coarse.areas = np.bincount(patches, weights=self.model.areas, minlength=count)
+        coarse.weighted_normals = accumulate(self.vsa.weighted_normals)
+        length = np.linalg.norm(coarse.weighted_normals, axis=1)
+        coarse.normals = coarse.weighted_normals / np.where(length > 0, length, 1)[:, None]
+        coarse.centroids = accumulate(self.vsa.weighted_centroids) / np.maximum(coarse.areas, 1e-300)[:, None]
+        if self.metric == 'L2':
+            coarse.moments = accumulate(self.vsa.moments)
+        # patches are adjacent when any of their triangles are
+        sources, targets = self.model.get_adjacent_pairs()
+        a, b = patches[sources], patches[targets]
+        pairs = np.unique(a[a != b] * count + b[a != b])
+        coarse.adjacency_offsets, coarse.adjacency_indices = OBJ.get_csr(pairs, count)
+        return coarse
+
+    def train(self, coarse_iteration=10, fine_iteration=2):
+        # converge on patches
+        patches = self.get_patches()
+        coarse = CoarseVSA(self.get_coarse_model(patches), self.k, self.metric)
+        coarse.train(coarse_iteration, render=False)
+        # project regions and proxies onto the triangles
+        vsa = self.vsa
+        vsa.labels = coarse.labels[patches]
+        vsa.regions = [np.flatnonzero(vsa.labels == i).tolist() for i in range(self.k)]
+        vsa.proxies = [Proxy(proxy.x.copy(), proxy.n.copy()) for proxy in coarse.proxies]
+        # refine on the triangles, reseeding from the projected regions
+        for i in range(fine_iteration):
+            vsa.geometry_partition(i + 1)
+            vsa.proxy_adjustment()
+        return vsa
@@ -1,11 +1,12 @@
 from obj import OBJ
 from vsa import VSA
 
-obj_path = OBJ('../asset/bunny.obj')
+obj_path = OBJ('../asset/bunny.obj', cache_directory='../cache')
 K = 100
 iteration_time = 10
+metric = 'L21'
 
 if __name__ == '__main__':
-    vsa1 = VSA(obj_path, K)
+    vsa1 = VSA(obj_path, K, metric)
     vsa1.train(iteration_time)
 
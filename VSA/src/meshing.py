@@ -0,0 +1,245 @@
+import os
+import numpy as np
+from vsa import VSA
+
+# binary PLY face record, a vertex count followed by three vertex ids
+ply_face = np.dtype([('count', 'u1'), ('vertices', '<i4', (3,))])
+
+
+def save_ply(path, vertices, faces, chunk_size=1 << 16):
+    # write a binary little endian PLY in chunks, float32 positions and int32 ids
+    with open(path, 'wb') as f:
+        header = ('ply\nformat binary_little_endian 1.0\n'
+                  'element vertex {}\nproperty float x\nproperty float y\nproperty float z\n'
+                  'element face {}\nproperty list uchar int vertex_indices\nend_header\n')
+        f.write(header.format(len(vertices), len(faces)).encode('ascii'))
+        for start in range(0, len(vertices), chunk_size):
+            np.asarray(vertices[start:start + chunk_size], dtype='<f4').tofile(f)
+        for start in range(0, len(faces), chunk_size):
+            records = np.empty(len(faces[start:start + chunk_size]), dtype=ply_face)
+            records['count'] = 3
+            records['vertices'] = faces[start:start + chunk_size]
+            records.tofile(f)
+
+
+def save_obj(path, vertices, faces, chunk_size=1 << 16):
+    # write a text Wavefront OBJ in chunks, ids in OBJ are 1-based
+    with open(path, 'w') as f:
+        for start in range(0, len(vertices), chunk_size):
+            np.savetxt(f, vertices[start:start + chunk_size], fmt='v %.7g %.7g %.7g')
+        for start in range(0, len(faces), chunk_size):
+            np.savetxt(f, faces[start:start + chunk_size] + 1, fmt='f %d %d %d')
+
+
+def save_mesh(path, vertices, faces):
+    # choose format by extension
+    extension = os.path.splitext(path)[1].lower()
+    assert extension in ('.ply', '.obj'), 'unknown mesh format {}'.format(extension)
+    (save_ply if extension == '.ply' else save_obj)(path, vertices, faces)
+
+
+class Mesher:
+    # build a polygon mesh from a VSA partition, one triangulated polygon of anchors per region
+    def __init__(self, vsa: VSA, tolerance: float = 0.2):
+        self.vsa = vsa
+        self.model = vsa.model
+        # split a boundary chain when it strays from its chord by more than tolerance * chord length
+        self.tolerance = tolerance
+        self.vertex_count = len(self.model.vertices)
+
+    def get_vertex_regions(self):
+        # get every distinct (vertex, region) pair of the partition as two arrays
+        k = self.vsa.k + 1
+        pairs = np.unique(self.model.faces.ravel() * k + np.repeat(self.vsa.labels, 3) + 1)
+        return pairs // k, pairs % k - 1
+
+    def get_boundary_edges(self):
+        # half edges of every face in face order, labelled with the face's region
+        a = self.model.faces.ravel()
+        b = self.model.faces[:, [1, 2, 0]].ravel()
+        labels = np.repeat(self.vsa.labels, 3)
+        # find each half edge's twin, half edges on the mesh border have none
+        keys = a * self.vertex_count + b
+        order = np.argsort(keys)
+        twins = b * self.vertex_count + a
+        index = np.minimum(np.searchsorted(keys[order], twins), len(keys) - 1)
+        found = keys[order][index] == twins
+        twin_labels = np.where(found, labels[order][index], -2)
+        # a half edge is on a region boundary when its twin belongs to another region or is missing
+        boundary = (labels >= 0) & (labels != twin_labels)
+        return a[boundary], b[boundary], labels[boundary], ~found[boundary]
+
+    def get_anchors(self, a, b, border):
+        # anchors are vertices shared by three regions, or by two regions on the mesh border
+        vertices, _ = self.get_vertex_regions()
+        counts = np.bincount(vertices, minlength=self.vertex_count)
+        anchors = counts >= 3
+        on_border = np.zeros(self.vertex_count, dtype=bool)
+        on_border[a[border]] = True
+        on_border[b[border]] = True
+        anchors |= on_border & (counts >= 2)
+        return anchors
+
+    @staticmethod
+    def get_loops(a, b, labels):
+        # chain boundary half edges of every region into closed loops of vertex ids
+        successors = {}
+        for start, end, label in zip(a.tolist(), b.tolist(), labels.tolist()):
+            successors.setdefault((label, start), []).append(end)
+        loops = []
+        for label, start in list(successors):
+            while successors[(label, start)]:
+                loop = [start]
+                current = successors[(label, start)].pop()
+                while current != start and successors.get((label, current)):
+                    loop.append(current)
+                    current = successors[(label, current)].pop()
+                loops.append((label, np.array(loop, dtype=np.int64)))
+        return loops
+
+    def add_anchors(self, loops, anchors):
+        # every loop needs three anchors to form a polygon, split its longest open stretch until it has
+        added = False
+        for _, loop in loops:
+            while anchors[loop].sum() < 3 and len(loop) >= 3:
+                index = np.flatnonzero(anchors[loop])
+                if len(index) == 0:
+                    anchors[loop[0]] = True
+                else:
+                    gaps = np.diff(np.append(index, index[0] + len(loop)))
+                    longest = np.argmax(gaps)
+                    anchors[loop[(index[longest] + gaps[longest] // 2) % len(loop)]] = True
+                added = True
+        return added
+
+    def refine_anchors(self, loops, anchors):
+        # split chains between consecutive anchors at the vertex farthest from their chord
+        added = False
+        for _, loop in loops:
+            index = np.flatnonzero(anchors[loop])
+            for start, end in zip(index, np.append(index[1:], index[0] + len(loop))):
+                if end - start < 2:
+                    continue
+                chain = self.model.vertices[loop[np.arange(start, end + 1) % len(loop)]]
+                chord = chain[-1] - chain[0]
+                length = np.linalg.norm(chord)
+                if length == 0:
+                    continue
+                distances = np.linalg.norm(np.cross(chain[1:-1] - chain[0], chord), axis=1) / length
+                farthest = np.argmax(distances)
+                if distances[farthest] > self.tolerance * length:
+                    anchors[loop[(start + 1 + farthest) % len(loop)]] = True
+                    added = True
+        return added
+
+    def get_anchor_positions(self, anchors):
+        # place every anchor at the average of its projections onto the planes of its regions
+        vertices, regions = self.get_vertex_regions()
+        keep = anchors[vertices] & (regions >= 0)
+        vertices, regions = vertices[keep], regions[keep]
+        normals, points = self.vsa.get_proxy_arrays()
+        p = self.model.vertices[vertices]
+        n = normals[regions]
+        projected = p - ((p - points[regions]) * n).sum(axis=1)[:, None] * n
+        counts = np.bincount(vertices, minlength=self.vertex_count)
+        positions = np.stack([np.bincount(vertices, weights=projected[:, j], minlength=self.vertex_count)
+                              for j in range(3)], axis=1)
+        ids = np.flatnonzero(anchors)
+        return positions[ids] / np.maximum(counts[ids], 1)[:, None]
+
+    @staticmethod
+    def get_plane_coordinates(points, n):
+        # coordinates in a basis u, w of the plane with normal n, where u x w = n
+        u = np.cross(n, [1, 0, 0] if abs(n[0]) < 0.9 else [0, 1, 0])
+        u /= np.linalg.norm(u)
+        w = np.cross(n, u)
+        return np.column_stack((points @ u, points @ w))
+
+    @staticmethod
+    def get_signed_area(coordinates):
+        # positive for counter clockwise polygons
+        x, y = coordinates[:, 0], coordinates[:, 1]
+        return (x * np.roll(y, -1) - np.roll(x, -1) * y).sum() / 2
+
+    @staticmethod
+    def triangulate(coordinates):
+        # ear clipping of a counter clockwise polygon, triangles are positions in coordinates
+        remaining = list(range(len(coordinates)))
+        triangles = []
+        while len(remaining) > 3:
+            count = len(remaining)
+            corners = np.array([[remaining[j - 1], remaining[j], remaining[(j + 1) % count]] for j in range(count)])
+            a, b, c = coordinates[corners[:, 0]], coordinates[corners[:, 1]], coordinates[corners[:, 2]]
+            convex = (b - a)[:, 0] * (c - b)[:, 1] - (b - a)[:, 1] * (c - b)[:, 0]
+            ear = None
+            for j in np.argsort(-convex):
+                if convex[j] <= 0:
+                    break
+                # an ear holds no other vertex strictly inside
+                others = coordinates[[r for r in remaining if r not in corners[j]]]
+                inside = np.ones(len(others), dtype=bool)
+                for p, q in ((a[j], b[j]), (b[j], c[j]), (c[j], a[j])):
+                    inside &= (q - p)[0] * (others - p)[:, 1] - (q - p)[1] * (others - p)[:, 0] > 0
+                if not inside.any():
+                    ear = j
+                    break
+            # clip the most convex corner of a degenerate polygon without ears
+            ear = int(np.argmax(convex)) if ear is None else ear
+            triangles.append(corners[ear])
+            remaining.pop(ear)
+        triangles.append(remaining)
+        return np.array(triangles, dtype=np.int64)
+
+    def get_polygons(self, loops, anchors):
+        # anchor polygons of every region in the proxy plane, holes are bridged into the outer polygon
+        groups = {}
+        for label, loop in loops:
+            polygon = loop[anchors[loop]]
+            if len(polygon) >= 3:
+                groups.setdefault(label, []).append(polygon)
+        for label, group in groups.items():
+            n = self.vsa.proxies[label].n
+            coordinates = [self.get_plane_coordinates(self.model.vertices[polygon], n) for polygon in group]
+            areas = [self.get_signed_area(c) for c in coordinates]
+            outers = [i for i in range(len(group)) if areas[i] > 0]
+            if not outers:
+                # the proxy faces away from every loop, keep them apart
+                for polygon, c in zip(group, coordinates):
+                    yield polygon, c
+                continue
+            polygons = {i: (group[i], coordinates[i]) for i in outers}
+            for hole in (i for i in range(len(group)) if areas[i] <= 0):
+                # join the hole to the outer polygon at its closest pair of vertices
+                distances = {i: np.linalg.norm(polygons[i][1][:, None] - coordinates[hole], axis=2) for i in outers}
+                outer = min(outers, key=lambda i: distances[i].min())
+                i, j = np.unravel_index(np.argmin(distances[outer]), distances[outer].shape)
+                polygon, c = polygons[outer]
+                order = np.concatenate((np.arange(j, len(group[hole])), np.arange(j + 1)))
+                polygons[outer] = (np.concatenate((polygon[:i + 1], group[hole][order], polygon[i:])),
+                                   np.concatenate((c[:i + 1], coordinates[hole][order], c[i:])))
+            yield from polygons.values()
+
+    def mesh(self):
+        a, b, labels, border = self.get_boundary_edges()
+        anchors = self.get_anchors(a, b, border)
+        loops = self.get_loops(a, b, labels)
+        # anchors are shared, so a chain refined for one region is refined for its neighbour too
+        while self.add_anchors(loops, anchors) | self.refine_anchors(loops, anchors):
+            pass
+        vertices = self.get_anchor_positions(anchors)
+        ids = np.cumsum(anchors) - 1
+        # triangulate every polygon in its proxy plane, keeping the orientation of the faces
+        faces = []
+        for polygon, coordinates in self.get_polygons(loops, anchors):
+            if self.get_signed_area(coordinates) >= 0:
+                faces.append(ids[polygon][self.triangulate(coordinates)])
+            else:
+                faces.append(ids[polygon[::-1]][self.triangulate(coordinates[::-1])][:, ::-1])
+        faces = np.concatenate(faces) if faces else np.empty((0, 3), dtype=np.int64)
+        return vertices, faces
+
+    def save(self, path):
+        # mesh the partition and write it as PLY or OBJ
+        vertices, faces = self.mesh()
+        save_mesh(path, vertices, faces)
+        return vertices, faces
@@ -0,0 +1,82 @@
+import io
+import time
+import random
+import contextlib
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from obj import OBJ
+from vsa import VSA, Proxy
+
+# model and settings of a worker process, set once by attach
+worker = {}
+
+
+def share(model: OBJ):
+    # copy mesh arrays into shared memory blocks, workers map them instead of unpickling OBJ
+    blocks, specs = [], []
+    for name in OBJ.arrays:
+        array = getattr(model, name)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs.append((name, block.name, array.shape, array.dtype.str))
+    return blocks, specs
+
+
+def attach(specs, k, metric):
+    # build a read-only OBJ over the shared blocks
+    model = OBJ()
+    blocks = []
+    for name, block_name, shape, dtype in specs:
+        block = shared_memory.SharedMemory(name=block_name)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        setattr(model, name, array)
+        blocks.append(block)
+    worker.update(model=model, blocks=blocks, k=k, metric=metric)
+
+
+def run(seed, iteration):
+    # train one seeded VSA without rendering
+    start = time.perf_counter()
+    random.seed(seed)
+    vsa = VSA(worker['model'], worker['k'], worker['metric'])
+    with contextlib.redirect_stdout(io.StringIO()):
+        vsa.train(iteration, render=False)
+    normals, points = vsa.get_proxy_arrays()
+    return {'seed': seed, 'error': float(vsa.region_errors.sum()), 'time': time.perf_counter() - start,
+            'labels': vsa.labels, 'normals': normals, 'points': points}
+
+
+class MultiStartVSA:
+    def __init__(self, model: OBJ, k: int, metric: str = 'L21', workers: int = None):
+        self.model = model
+        self.k = k
+        self.metric = metric
+        self.workers = workers
+        # error and time of every seed
+        self.statistics = []
+
+    def train(self, seeds, iteration):
+        # run one VSA per seed in a process pool, sharing the mesh arrays
+        blocks, specs = share(self.model)
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=attach,
+                                     initargs=(specs, self.k, self.metric)) as executor:
+                results = list(executor.map(run, seeds, [iteration] * len(seeds)))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+        self.statistics = [{key: result[key] for key in ('seed', 'error', 'time')} for result in results]
+        for statistic in self.statistics:
+            print('seed {seed}: global error {error}, {time:.3f}s'.format(**statistic))
+        # rebuild the partition with the lowest global error
+        best = min(results, key=lambda result: result['error'])
+        vsa = VSA(self.model, self.k, self.metric)
+        vsa.labels = best['labels']
+        vsa.regions = [np.flatnonzero(vsa.labels == i).tolist() for i in range(self.k)]
+        vsa.proxies = [Proxy(x, n) for n, x in zip(best['normals'], best['points'])]
+        vsa.region_errors = vsa.get_region_errors()
+        return vsa
@@ -1,5 +1,47 @@
+import os
+import shutil
+import hashlib
 import trimesh
-from triangle import Triangle
+import numpy as np
+
+
+class MeshCache:
+    def __init__(self, directory: str):
+        # arrays of a mesh are stored as <content hash>/<array name>.npy in directory
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def get_key(path, chunk_size=1 << 20):
+        # hash file content, so renamed or copied meshes share one entry
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def load(self, path, names):
+        # memory-map cached arrays read-only, None on a miss
+        entry = os.path.join(self.directory, self.get_key(path))
+        paths = [os.path.join(entry, '{}.npy'.format(name)) for name in names]
+        if not all(os.path.exists(array_path) for array_path in paths):
+            return None
+        return {name: np.load(array_path, mmap_mode='r') for name, array_path in zip(names, paths)}
+
+    def store(self, path, arrays):
+        # write to a temporary directory first, so concurrent processes never read a partial entry
+        entry = os.path.join(self.directory, self.get_key(path))
+        temp_entry = '{}.{}.tmp'.format(entry, os.getpid())
+        os.makedirs(temp_entry, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_entry, '{}.npy'.format(name)), array)
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.replace(temp_entry, entry)
+        except OSError:
+            # another process stored the same entry meanwhile
+            shutil.rmtree(temp_entry, ignore_errors=True)
 
 
 class OBJ:
@@ -7,48 +49,85 @@ class OBJ:
     def load(path):
         return trimesh.load(path)
 
-    def __init__(self, filename):
-        # load mesh
-        self.mesh = self.load(filename)
-        # record each triangle in the format of (v1, v2, v3, n)
-        self.triangles = []
-        for i in range(len(self.mesh.faces)):
-            # get the vertices of the triangle
-            v1 = self.mesh.vertices[self.mesh.faces[i][0]]
-            v2 = self.mesh.vertices[self.mesh.faces[i][1]]
-            v3 = self.mesh.vertices[self.mesh.faces[i][2]]
-            # get the normal vector of the triangle
-            n = self.mesh.face_normals[i]
-            # create a triangle
-            t = Triangle(v1, v2, v3, n)
-            # add the triangle to the list
-            self.triangles.append(t)
-
-    def get_adjacent_triangles(self, triangle):
-        # check if the triangle is in the mesh
-        if triangle not in self.triangles:
-            assert False, 'triangle not in the mesh'
-
-        # get the adjacent triangles of a triangle
-        adjacent_triangles = []
-        for i in range(len(self.triangles)):
-            # check if the triangle shares two vertices with the triangle
-            count = 0
-            for v in triangle:
-                if (v[0] == self.triangles[i].v1[0] and
-                        v[1] == self.triangles[i].v1[1] and
-                        v[2] == self.triangles[i].v1[2]) or \
-                   (v[0] == self.triangles[i].v2[0] and
-                        v[1] == self.triangles[i].v2[1] and
-                        v[2] == self.triangles[i].v2[2]) or \
-                   (v[0] == self.triangles[i].v3[0] and
-                        v[1] == self.triangles[i].v3[1] and
-                        v[2] == self.triangles[i].v3[2]):
-                    count += 1
-            # skip count = 0 or 1 or 3
-            if count == 2:
-                adjacent_triangles.append(self.triangles[i])
-        return adjacent_triangles
+    @staticmethod
+    def build_adjacency(faces):
+        # every face has three undirected edges
+        faces = np.asarray(faces, dtype=np.int64)
+        count = len(faces)
+        edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+        owners = np.repeat(np.arange(count), 3)
+        # sort edges, so faces sharing an edge are next to each other
+        order = np.lexsort((edges[:, 1], edges[:, 0]))
+        edges, owners = edges[order], owners[order]
+        # pair faces d apart inside a group of equal edges, groups over two are non-manifold edges
+        pairs = [np.empty(0, dtype=np.int64)]
+        for d in range(1, len(edges)):
+            same = (edges[d:] == edges[:-d]).all(axis=1)
+            if not same.any():
+                break
+            pairs.append(owners[:-d][same] * count + owners[d:][same])
+            pairs.append(owners[d:][same] * count + owners[:-d][same])
+        pairs, shared = np.unique(np.concatenate(pairs), return_counts=True)
+        # neighbours share exactly one edge, i.e. two vertices
+        pairs = pairs[(shared == 1) & (pairs // count != pairs % count)]
+        return OBJ.get_csr(pairs, count)
+
+    @staticmethod
+    def get_csr(pairs, count):
+        # store neighbours of every face as CSR arrays, sorted by face id,
+        # pairs are sorted keys of source * count + target
+        sources, targets = pairs // count, pairs % count
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=count))))
+        return offsets, targets
+
+    # arrays that fully describe a loaded mesh
+    arrays = ('vertices', 'faces', 'areas', 'normals', 'centroids', 'adjacency_offsets', 'adjacency_indices')
+
+    def __init__(self, filename=None, cache_directory=None):
+        # memory-map preprocessed arrays when the mesh is cached
+        arrays = MeshCache(cache_directory).load(filename, self.arrays) if filename and cache_directory else None
+        if arrays:
+            for name, array in arrays.items():
+                setattr(self, name, array)
+        elif filename:
+            # load mesh
+            mesh = self.load(filename)
+            # record faces as contiguous arrays indexed by face id instead of one object per face
+            self.vertices = np.ascontiguousarray(mesh.vertices, dtype=np.float64)
+            self.faces = np.ascontiguousarray(mesh.faces, dtype=np.int64)
+            self.set_face_attributes()
+            # build edge adjacency of faces once
+            self.adjacency_offsets, self.adjacency_indices = self.build_adjacency(self.faces)
+            if cache_directory:
+                MeshCache(cache_directory).store(filename, {name: getattr(self, name) for name in self.arrays})
+
+    def set_face_attributes(self):
+        # corners of every face
+        v1 = self.vertices[self.faces[:, 0]]
+        v2 = self.vertices[self.faces[:, 1]]
+        v3 = self.vertices[self.faces[:, 2]]
+        # area is half the length of the cross product, normal is its direction
+        cp = np.cross(v2 - v1, v3 - v1)
+        length = np.linalg.norm(cp, axis=1)
+        self.areas = length / 2
+        self.normals = cp / np.where(length > 0, length, 1)[:, None]
+        self.centroids = (v1 + v2 + v3) / 3
+
+    def get_adjacent_triangles(self, tid):
+        # get ids of the triangles sharing an edge with triangle tid
+        return self.adjacency_indices[self.adjacency_offsets[tid]:self.adjacency_offsets[tid + 1]]
+
+    def get_adjacent_triangles_of(self, tids):
+        # get ids of the triangles sharing an edge with any of tids, with repeats
+        starts = self.adjacency_offsets[tids]
+        counts = self.adjacency_offsets[tids + 1] - starts
+        shifts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return self.adjacency_indices[shifts + np.arange(counts.sum())]
+
+    def get_adjacent_pairs(self):
+        # get every adjacent pair of triangles in both directions as two arrays
+        sources = np.repeat(np.arange(len(self.adjacency_offsets) - 1), np.diff(self.adjacency_offsets))
+        return sources, self.adjacency_indices
 
 
 if __name__ == '__main__':
@@ -1,5 +1,10 @@
 import vtk
 import random
+import numpy as np
+from vtk.util import numpy_support
+
+# numpy dtype of vtkIdType, cell arrays are shared with VTK only in this type
+id_type = numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE)
 
 
 def get_unique_colors(num_colors):
@@ -10,59 +15,84 @@ def get_unique_colors(num_colors):
     return colors
 
 
-def save_rendering(filename, triangles, regions):
-    # Initialize rendering window and renderer
-    renderer = vtk.vtkRenderer()
-    render_window = vtk.vtkRenderWindow()
-    render_window.AddRenderer(renderer)
-    # Enable off-screen rendering
-    render_window.SetOffScreenRendering(1)
-    render_window_interactor = vtk.vtkRenderWindowInteractor()
-    render_window_interactor.SetRenderWindow(render_window)
-
-    unique_colors = get_unique_colors(len(regions))
+class Renderer:
+    # off-screen renderer of one mesh, faces are colored by region through a lookup table,
+    # the window and the polydata are built once and only the labels change between renderings
+    def __init__(self, model):
+        # keep the arrays VTK reads from alive, they are shared without copying
+        self.vertices = np.ascontiguousarray(model.vertices, dtype=np.float64)
+        self.connectivity = np.ascontiguousarray(model.faces.ravel(), dtype=id_type)
+        self.offsets = np.arange(0, len(self.connectivity) + 1, 3, dtype=id_type)
+        self.labels = np.zeros(len(model.faces), dtype=np.int32)
+        # number of regions the lookup table is colored for, a new table already holds 256 default values
+        self.k = None
 
-    # deal with each region
-    for region_id, region_triangles in enumerate(regions):
+        # one polydata of the whole mesh
         points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(self.vertices, deep=False))
         polys = vtk.vtkCellArray()
-
-        # deal with each triangle in the region
-        for tri_id in region_triangles:
-            tri = triangles[tri_id]
-            triangle = vtk.vtkTriangle()
-
-            for i in range(3):
-                point_id = points.InsertNextPoint(tri[i][:3])
-                triangle.GetPointIds().SetId(i, point_id)
-
-            polys.InsertNextCell(triangle)
-
-        # Create a polydata object
+        polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(self.offsets, deep=False),
+                      numpy_support.numpy_to_vtkIdTypeArray(self.connectivity, deep=False))
+        self.scalars = numpy_support.numpy_to_vtk(self.labels, deep=False)
         poly_data = vtk.vtkPolyData()
         poly_data.SetPoints(points)
         poly_data.SetPolys(polys)
+        poly_data.GetCellData().SetScalars(self.scalars)
 
-        # Create a mapper and actor
-        mapper = vtk.vtkPolyDataMapper()
-        mapper.SetInputData(poly_data)
+        # map labels to colors per face
+        self.lookup_table = vtk.vtkLookupTable()
+        self.mapper = vtk.vtkPolyDataMapper()
+        self.mapper.SetInputData(poly_data)
+        self.mapper.SetScalarModeToUseCellData()
+        self.mapper.SetLookupTable(self.lookup_table)
+        self.mapper.ScalarVisibilityOn()
         actor = vtk.vtkActor()
-        actor.SetMapper(mapper)
-        actor.GetProperty().SetColor(unique_colors[region_id])
+        actor.SetMapper(self.mapper)
+
+        # Initialize rendering window and renderer
+        renderer = vtk.vtkRenderer()
         renderer.AddActor(actor)
+        # Set background color, e.g., dark blue
+        renderer.SetBackground(0.1, 0.2, 0.4)
+        self.render_window = vtk.vtkRenderWindow()
+        self.render_window.AddRenderer(renderer)
+        # Enable off-screen rendering
+        self.render_window.SetOffScreenRendering(1)
+
+        # Capture the render window and write it as PNG
+        self.window_to_image_filter = vtk.vtkWindowToImageFilter()
+        self.window_to_image_filter.SetInput(self.render_window)
+        self.writer = vtk.vtkPNGWriter()
+        self.writer.SetInputConnection(self.window_to_image_filter.GetOutputPort())
 
-    # Set background color, e.g., dark blue
-    renderer.SetBackground(0.1, 0.2, 0.4)
-    # Perform off-screen rendering
-    render_window.Render()
+    def set_colors(self, k):
+        # one random color per region, kept while k stays the same
+        if self.k == k:
+            return
+        self.k = k
+        self.lookup_table.SetNumberOfTableValues(k)
+        for i, color in enumerate(get_unique_colors(k)):
+            self.lookup_table.SetTableValue(i, *color, 1.0)
+        # label i maps to the i-th table value
+        self.lookup_table.SetTableRange(-0.5, k - 0.5)
+        self.mapper.SetScalarRange(-0.5, k - 0.5)
 
-    # Capture the render window
-    window_to_image_filter = vtk.vtkWindowToImageFilter()
-    window_to_image_filter.SetInput(render_window)
-    window_to_image_filter.Update()
+    def save(self, filename, labels, k):
+        # update labels in place, VTK shares their memory
+        self.set_colors(k)
+        self.labels[:] = labels
+        self.scalars.Modified()
+        # Perform off-screen rendering
+        self.render_window.Render()
+        self.window_to_image_filter.Modified()
+        # Save the rendering result
+        self.writer.SetFileName(filename)
+        self.writer.Write()
 
-    # Save the rendering result
-    writer = vtk.vtkPNGWriter()
-    writer.SetFileName(filename)
-    writer.SetInputConnection(window_to_image_filter.GetOutputPort())
-    writer.Write()
+
+def save_rendering(filename, model, regions):
+    # render once, label faces by their region
+    labels = np.zeros(len(model.faces), dtype=np.int32)
+    for region_id, region_triangles in enumerate(regions):
+        labels[region_triangles] = region_id
+    Renderer(model).save(filename, labels, len(regions))
@@ -1,10 +1,10 @@
 import random
+import heapq
+import numpy as np
 from obj import OBJ
-from triangle import Triangle
-from queue import PriorityQueue
 import tqdm
 import os
-from visualize import save_rendering
+from visualize import Renderer
 
 
 class Proxy:
@@ -14,212 +14,318 @@ class Proxy:
         self.n = n
 
 
-class MyPriorityQueue:
-    def __init__(self, distance, triangle, proxy):
-        # each element in the priority queue is a tuple of (distance, triangle, proxy)
-        self.distance = distance
-        self.triangle = triangle
-        self.proxy = proxy
-
-    def __gt__(self, other):
-        return self.distance > other.distance
-
-    def __eq__(self, other):
-        return self.distance == other.distance
-
-
 class VSA:
     # Vertex Simplification Algorithm
-    def __init__(self, model: OBJ, k: int):
+    # metric 'L21' compares normals, 'L2' integrates squared distances to the proxy plane
+    metrics = ('L21', 'L2')
+
+    def __init__(self, model: OBJ, k: int, metric: str = 'L21'):
+        assert metric in self.metrics, 'unknown metric {}'.format(metric)
         self.model = model
-        self.triangles = self.model.triangles
+        self.face_count = len(self.model.areas)
         self.k = k
+        self.metric = metric
+        # area weighted face attributes, summed per region when fitting proxies
+        self.weighted_normals = self.model.areas[:, None] * self.model.normals
+        self.weighted_centroids = self.model.areas[:, None] * self.model.centroids
+        if self.metric == 'L2':
+            self.moments = self.get_moments()
         # initialize regions(use index) and proxies
         self.regions = [[] for _ in range(self.k)]
         self.proxies = []
-        # initialize labels and distances
-        self.labels = [-1 for _ in range(len(self.triangles))]
-        self.distances = [1e9 for _ in range(len(self.triangles))]
-        self.conquered = [False for _ in range(len(self.triangles))]
-
-    @staticmethod
-    def get_distance(n1, n2):
-        # get distance between two normal vectors
-        return (n1[0] - n2[0]) ** 2 + (n1[1] - n2[1]) ** 2 + (n1[2] - n2[2]) ** 2
-
-    def get_tp_distance(self, t: Triangle, p: Proxy):
-        # get distance between a triangle and a proxy
-        # use the distance of the normal vector difference and the area of the triangle
-        return t.area() * self.get_distance(t.n, p.n)
-
-    def get_rp_distance(self, region, proxy):
-        # get distance between a region and a proxy
-        # equal to the sum of the distances between the triangles and the proxy
-        rp_distance = 0
-        for tid in region:
-            rp_distance += self.get_tp_distance(self.triangles[tid], proxy)
-        return rp_distance
+        # initialize labels(face to region) and conquered flags
+        self.labels = np.full(self.face_count, -1, dtype=np.int64)
+        self.conquered = np.zeros(self.face_count, dtype=bool)
+        # error of every region to its proxy, kept up to date by proxy_adjustment
+        self.region_errors = np.zeros(self.k)
+        # renderer is created on the first rendering and reused after
+        self.renderer = None
+
+    def get_moments(self):
+        # second moment of every triangle, integral of p * p^T over its area
+        corners = self.model.vertices[self.model.faces]
+        return self.model.areas[:, None, None] / 12 * (
+            np.einsum('fij,fik->fjk', corners, corners) +
+            9 * np.einsum('fj,fk->fjk', self.model.centroids, self.model.centroids))
+
+    def get_errors(self, tids, n, x):
+        # get errors between triangles and proxies given by normal n and point x,
+        # either one proxy for all triangles or one proxy per triangle
+        areas = self.model.areas[tids]
+        if self.metric == 'L21':
+            # area weighted squared difference of normals
+            return areas * ((self.model.normals[tids] - n) ** 2).sum(axis=-1)
+        # integral of squared distance to the proxy plane over the triangle
+        d = ((self.model.vertices[self.model.faces[tids]] - np.expand_dims(x, -2)) * np.expand_dims(n, -2)).sum(axis=-1)
+        return areas / 6 * ((d ** 2).sum(axis=-1) + d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+    def get_tp_distances(self, tids, pid: int):
+        # get distances between many triangles and a proxy at once
+        return self.get_errors(tids, self.proxies[pid].n, self.proxies[pid].x)
+
+    def get_proxy_arrays(self):
+        # get normals and points of all proxies as arrays
+        return np.array([proxy.n for proxy in self.proxies]), np.array([proxy.x for proxy in self.proxies])
+
+    def get_tids(self, pids=None):
+        # get triangles of given regions, all assigned triangles by default
+        if pids is None:
+            return np.flatnonzero(self.labels >= 0)
+        return np.concatenate([np.asarray(self.regions[i], dtype=np.int64) for i in pids])
+
+    def accumulate(self, values, pids=None):
+        # sum per triangle values of every region with one bincount per component,
+        # only triangles of given regions are visited when pids is given
+        tids = self.get_tids(pids)
+        flat = values[tids].reshape(len(tids), -1)
+        sums = [np.bincount(self.labels[tids], weights=flat[:, j], minlength=self.k) for j in range(flat.shape[1])]
+        return np.stack(sums, axis=1).reshape((self.k,) + values.shape[1:])
 
     def initialize_regions_and_proxies(self):
         # generate k different random integer between 0 and len(triangles)
-        random_indices = random.sample(range(len(self.triangles)), self.k)
+        random_indices = random.sample(range(self.face_count), self.k)
         # initialize regions and proxies
         for i in range(self.k):
             # add a triangle to each region
-            triangle = self.triangles[random_indices[i]]
-            self.regions[i].append(random_indices[i])
+            tid = random_indices[i]
+            self.regions[i].append(tid)
             # add a proxy
-            self.proxies.append(Proxy(triangle.v1, triangle.n))
+            self.proxies.append(Proxy(self.model.centroids[tid], self.model.normals[tid]))
             # make sure each region only has one triangle
             assert len(self.regions[i]) == 1
 
-    def create_priority_queue(self):
-        # initialize priority queue at first time
-        pq = PriorityQueue()
+    def push_adjacent_triangles(self, heap, tid, pid):
+        # push unconquered neighbours of a triangle with their distances to the proxy
+        adjacent_tids = self.model.get_adjacent_triangles(tid)
+        adjacent_tids = adjacent_tids[~self.conquered[adjacent_tids]]
+        distances = self.get_tp_distances(adjacent_tids, pid)
+        for distance, adjacent_tid in zip(distances.tolist(), adjacent_tids.tolist()):
+            heapq.heappush(heap, (distance, adjacent_tid, pid))
 
-        for i in range(self.k):
-            # put the triangle in the region into the priority queue
+    def create_priority_queue(self, pids):
+        # initialize priority queue, each element is a tuple of (distance, triangle id, proxy id)
+        heap = []
+
+        for i in pids:
+            # the seed triangle of each region is conquered directly
             tid = self.regions[i][0]
-            triangle = self.triangles[tid]
-            pq.put(MyPriorityQueue(self.get_tp_distance(triangle, self.proxies[i]),
-                                   triangle,
-                                   self.proxies[i]))
-            # mark the triangle as conquered
             self.conquered[tid] = True
+            self.labels[tid] = i
 
-            # consider adjacent triangles
-            adjacent_triangles = self.model.get_adjacent_triangles(triangle)
-            for adjacent_triangle in adjacent_triangles:
-                # put the adjacent triangles into the priority queue
-                pq.put(MyPriorityQueue(self.get_tp_distance(adjacent_triangle, self.proxies[i]),
-                                       adjacent_triangle,
-                                       self.proxies[i]))
-        return pq
+        for i in pids:
+            # put the adjacent triangles of the seed into the priority queue
+            self.push_adjacent_triangles(heap, self.regions[i][0], i)
+        return heap
 
-    def recalculate_regions(self):
-        # create priority queue at other times
+    def recalculate_regions(self, pids):
+        # reseed each region with its triangle closest to the proxy
+        for i in pids:
+            region = np.asarray(self.regions[i])
+            self.regions[i] = [int(region[np.argmin(self.get_tp_distances(region, i))])]
 
-        for i in range(self.k):
-            pq = PriorityQueue()
-
-            # get the region
-            region = self.regions[i]
-            # get the proxy
-            proxy = self.proxies[i]
-
-            for tid in region:
-                # get the triangle
-                triangle = self.triangles[tid]
-                # put the triangle into the priority queue
-                pq.put(MyPriorityQueue(self.get_tp_distance(triangle, proxy),
-                                       triangle,
-                                       proxy))
-
-            self.regions[i] = [self.triangles.index(pq.get().triangle)]
-            # make sure each region only has one triangle
-            assert len(self.regions[i]) == 1
-
-    def grow_regions(self, pq: PriorityQueue):
-        while pq.qsize() > 0:
+    def grow_regions(self, heap):
+        while heap:
             # get the triangle with the smallest distance
-            tp = pq.get()
-            triangle = tp.triangle
-            proxy = tp.proxy
+            distance, tid, pid = heapq.heappop(heap)
 
-            # check if the triangle is conquered
-            tid = self.triangles.index(triangle)
+            # skip stale entries of triangles conquered meanwhile
             if self.conquered[tid]:
                 continue
 
-            # add the triangle to the region
-            pid = self.proxies.index(proxy)
-            region = self.regions[pid]
-            region.append(tid)
-            # mark the triangle as conquered
+            # add the triangle to the region and mark it as conquered
+            self.regions[pid].append(tid)
             self.conquered[tid] = True
+            self.labels[tid] = pid
 
             # consider adjacent triangles
-            adjacent_triangles = self.model.get_adjacent_triangles(triangle)
-            for adjacent_triangle in adjacent_triangles:
-                # put the adjacent triangles into the priority queue
-                pq.put(MyPriorityQueue(self.get_tp_distance(adjacent_triangle, proxy),
-                                       adjacent_triangle,
-                                       proxy))
+            self.push_adjacent_triangles(heap, tid, pid)
 
     def geometry_partition(self, times):
-        self.conquered = [False for _ in range(len(self.triangles))]
+        self.conquered[:] = False
+        self.labels[:] = -1
         if times == 0:
             # initialize regions and proxies
             self.initialize_regions_and_proxies()
         else:
             # recalculate regions
-            self.recalculate_regions()
+            self.recalculate_regions(range(self.k))
 
         # initialize priority queue
-        pq = self.create_priority_queue()
+        heap = self.create_priority_queue(range(self.k))
         # grow regions
-        self.grow_regions(pq)
+        self.grow_regions(heap)
         self.get_global_error()
 
+    def repartition(self, pids):
+        # flood again only the triangles of given regions, other regions keep their triangles
+        tids = self.get_tids(pids)
+        old_labels = self.labels[tids]
+        self.recalculate_regions(pids)
+        self.conquered[:] = True
+        self.conquered[tids] = False
+        self.labels[tids] = -1
+        self.grow_regions(self.create_priority_queue(pids))
+        # triangles the flood cannot reach keep their region
+        lost = self.labels[tids] < 0
+        self.labels[tids[lost]] = old_labels[lost]
+        for i in pids:
+            self.regions[i] = tids[self.labels[tids] == i].tolist()
+
+    def get_region_errors(self, pids=None):
+        # get errors of triangles to their own proxy, summed per region
+        normals, points = self.get_proxy_arrays()
+        tids = self.get_tids(pids)
+        errors = self.get_errors(tids, normals[self.labels[tids]], points[self.labels[tids]])
+        return np.bincount(self.labels[tids], weights=errors, minlength=self.k)
+
     def get_global_error(self):
         # get the global error
-        global_error = 0
-        for i in range(self.k):
-            # get the region
-            region = self.regions[i]
-            # get the proxy
-            proxy = self.proxies[i]
-            # get the region-proxy distance
-            rp_distance = self.get_rp_distance(region, proxy)
-            # add the distance to the global error
-            global_error += rp_distance
+        self.region_errors = self.get_region_errors()
+        global_error = self.region_errors.sum()
         print("global error:{}".format(global_error))
         return global_error
 
-    def proxy_adjustment(self):
-        # adjust the proxies
-        for i in range(self.k):
-            # get the region
-            region = self.regions[i]
-            # get the proxy
-            proxy = self.proxies[i]
-            # compute the new proxy's normal vector
-            new_n = [0, 0, 0]
-            for tid in region:
-                triangle = self.triangles[tid]
-                triangle_size = triangle.area()
-                new_n[0] += triangle.n[0] * triangle_size
-                new_n[1] += triangle.n[1] * triangle_size
-                new_n[2] += triangle.n[2] * triangle_size
-            # normalize the new normal vector
-            new_n_squared = (new_n[0] ** 2 + new_n[1] ** 2 + new_n[2] ** 2) ** 0.5
-            new_n[0] /= new_n_squared
-            new_n[1] /= new_n_squared
-            new_n[2] /= new_n_squared
-
-            # compute the new proxy's x coordinate by baricentric coordinates
-            new_x = [0, 0, 0]
-            for tid in region:
-                triangle = self.triangles[tid]
-                new_x[0] += triangle.v1[0]
-                new_x[1] += triangle.v2[0]
-                new_x[2] += triangle.v3[0]
-            new_x[0] /= len(region)
-            new_x[1] /= len(region)
-            new_x[2] /= len(region)
-
+    def proxy_adjustment(self, pids=None):
+        # sum area, area weighted normals and centroids of all or given regions at once
+        area = self.accumulate(self.model.areas, pids)
+        weighted_normal = self.accumulate(self.weighted_normals, pids)
+        new_x = self.accumulate(self.weighted_centroids, pids) / np.maximum(area, 1e-300)[:, None]
+        if self.metric == 'L21':
+            # the new normal is the area weighted average normal
+            new_n = weighted_normal
+        else:
+            # the new normal is the direction of least variance of the region's covariance
+            covariance = self.accumulate(self.moments, pids) - area[:, None, None] * np.einsum('kj,kl->kjl', new_x, new_x)
+            new_n = np.linalg.eigh(covariance)[1][:, :, 0]
+            # orient the plane like the triangles
+            new_n *= np.where((new_n * weighted_normal).sum(axis=1) < 0, -1, 1)[:, None]
+        length = np.linalg.norm(new_n, axis=1)
+        for i in range(self.k) if pids is None else pids:
+            # keep the proxy of an empty or degenerate region
+            if area[i] == 0 or length[i] == 0:
+                continue
             # update the proxy
-            proxy.n = new_n
-            proxy.x = new_x
-
-    def train(self, iteration):
+            self.proxies[i].n = new_n[i] / length[i]
+            self.proxies[i].x = new_x[i]
+        # refresh errors of the adjusted regions
+        errors = self.get_region_errors(pids)
+        if pids is None:
+            self.region_errors = errors
+        else:
+            self.region_errors[pids] = errors[pids]
+
+    def get_neighbour_regions(self, pid):
+        # get regions sharing an edge with region pid
+        adjacent_tids = self.model.get_adjacent_triangles_of(np.asarray(self.regions[pid], dtype=np.int64))
+        neighbours = np.unique(self.labels[adjacent_tids])
+        return [int(i) for i in neighbours if i != pid and i >= 0]
+
+    def relax(self, pids, iterations=1):
+        # lloyd iterations restricted to given regions
+        pids = sorted(set(pids))
+        for _ in range(iterations):
+            self.repartition(pids)
+            self.proxy_adjustment(pids)
+
+    def get_fit_errors(self, area, weighted_normal, weighted_centroid, moment):
+        # get errors of the best fitting proxies of triangle sets from their summed statistics
+        if self.metric == 'L21':
+            # sum of a * |n_t - n|^2 is 2a - 2|sum of a * n_t| for the average normal n
+            return np.maximum(2 * area - 2 * np.linalg.norm(weighted_normal, axis=1), 0)
+        x = weighted_centroid / np.maximum(area, 1e-300)[:, None]
+        covariance = moment - area[:, None, None] * np.einsum('kj,kl->kjl', x, x)
+        return np.maximum(np.linalg.eigvalsh(covariance)[:, 0], 0)
+
+    def get_cheapest_merge(self):
+        # find pairs of adjacent regions
+        sources, targets = self.model.get_adjacent_pairs()
+        a, b = self.labels[sources], self.labels[targets]
+        adjacent = (a >= 0) & (a < b)
+        pairs = np.unique(a[adjacent] * self.k + b[adjacent])
+        a, b = pairs // self.k, pairs % self.k
+        # error of one proxy fitted to the union of two regions, from summed region statistics
+        statistics = [self.accumulate(values) for values in
+                      (self.model.areas, self.weighted_normals, self.weighted_centroids)]
+        statistics.append(self.accumulate(self.moments) if self.metric == 'L2' else np.zeros((self.k, 3, 3)))
+        merged = self.get_fit_errors(*[values[a] + values[b] for values in statistics])
+        cost = merged - self.region_errors[a] - self.region_errors[b]
+        best = np.argmin(cost)
+        return cost[best], int(a[best]), int(b[best])
+
+    def remove_proxy(self, pid, target):
+        # give triangles of region pid to region target
+        self.labels[self.regions[pid]] = target
+        self.regions[target] += self.regions[pid]
+        # move the last proxy into slot pid, so proxy ids stay contiguous
+        last = self.k - 1
+        if pid != last:
+            self.labels[self.regions[last]] = pid
+            self.regions[pid] = self.regions[last]
+            self.proxies[pid] = self.proxies[last]
+            self.region_errors[pid] = self.region_errors[last]
+            target = pid if target == last else target
+        self.regions.pop()
+        self.proxies.pop()
+        self.region_errors = self.region_errors[:last]
+        self.k -= 1
+        return target
+
+    def merge_proxies(self, iterations=1):
+        # merge the two adjacent regions whose union fits one proxy best
+        cost, a, b = self.get_cheapest_merge()
+        target = self.remove_proxy(b, a)
+        self.relax([target] + self.get_neighbour_regions(target), iterations)
+        return cost
+
+    def insert_proxy(self, iterations=1):
+        # split the worst region, it must have at least two triangles
+        sizes = np.array([len(region) for region in self.regions])
+        worst = int(np.argmax(np.where(sizes > 1, self.region_errors, -1)))
+        tids = np.asarray(self.regions[worst], dtype=np.int64)
+        # the new proxy starts at the triangle fitting the worst proxy worst
+        seed = int(tids[np.argmax(self.get_tp_distances(tids, worst))])
+        self.regions[worst].remove(seed)
+        pid = self.k
+        self.k += 1
+        self.labels[seed] = pid
+        self.regions.append([seed])
+        self.proxies.append(Proxy(self.model.centroids[seed], self.model.normals[seed]))
+        self.region_errors = np.append(self.region_errors, 0)
+        # partition and fit only around the worst region
+        self.relax([worst, pid] + self.get_neighbour_regions(worst), iterations)
+        return pid
+
+    def teleport_proxy(self, iterations=1):
+        # move a proxy from the cheapest merge to the worst region, if that lowers the error
+        cost, _, _ = self.get_cheapest_merge()
+        if cost >= self.region_errors.max():
+            return False
+        self.merge_proxies(iterations)
+        self.insert_proxy(iterations)
+        return True
+
+    def sweep(self, k_max, iteration=10, relax=1):
+        # converge at the current k unless already trained, then insert proxies one at a time up to k_max
+        if self.proxies:
+            self.region_errors = self.get_region_errors()
+        else:
+            self.train(iteration, render=False)
+        curve = [(self.k, self.region_errors.sum())]
+        for _ in tqdm.tqdm(range(self.k, k_max)):
+            self.insert_proxy(relax)
+            curve.append((self.k, self.region_errors.sum()))
+        return curve
+
+    def train(self, iteration, render=True):
         for i in tqdm.tqdm(range(iteration)):
+            self.geometry_partition(i)
+            self.proxy_adjustment()
+            if not render:
+                continue
             directory = '../result/bunny_K{}'.format(self.k)
             if not os.path.exists(directory):
                 os.makedirs(directory)
-            self.geometry_partition(i)
-            self.proxy_adjustment()
             filename = '{}/bunny_Iteration{}.png'.format(directory, i + 1)
-            save_rendering(filename, self.triangles, self.regions)
-
-
+            if self.renderer is None:
+                self.renderer = Renderer(self.model)
+            self.renderer.save(filename, self.labels, self.k)